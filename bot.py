@@ -1,13 +1,34 @@
 import asyncio
+import json
 import logging
 import re
-from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
 
-from config import BOT_TOKEN, ADMIN_USER_IDS, MESSAGES, BUTTONS
-from database import Database
+from config import (
+    BOT_TOKEN, ADMIN_USER_IDS, MESSAGES, BUTTONS, SEGMENTS, ADMIN_MENU_RETURN_DELAY,
+    ADMIN_DIGEST_THRESHOLD, ADMIN_DIGEST_WINDOW, ADMIN_DIGEST_INTERVAL, ADMIN_DIGEST_PAGE_SIZE,
+    APPLICATIONS_PAGE_SIZE, LISTING_BATCH_SIZE
+)
+from database import Database, AsyncDatabase, COMPLETION_BUCKETS
+from broadcast import BroadcastEngine
+from followups import FollowUpScheduler
+from outbox import OutboxDispatcher, PRIORITY_REPLY, PRIORITY_ADMIN
+from packer import send_listing
+from router import Router, callback_data
+from rendering import (
+    escape_markdown, status_emoji, main_menu_keyboard, ADMIN_PANEL_KEYBOARD, ADMIN_PANEL_TEXT,
+    BROADCAST_SEGMENT_KEYBOARD, BROADCAST_SCHEDULE_KEYBOARD,
+    render_application_card, invalidate_application_card
+)
+from ratelimit import RateLimiter
+from retry import RetryPolicy
+from updates import PerChatUpdateProcessor
 
 # Настройка логирования
 logging.basicConfig(
@@ -22,25 +43,67 @@ db = Database()
 class TelegramBot:
     def __init__(self):
         self.application = None
-        self.db = Database()
+        self.db = AsyncDatabase(db)
+        # Общий ограничитель частоты: очередь сообщений и рассылки делят лимит Telegram
+        self.limiter = RateLimiter()
+        self.outbox = OutboxDispatcher(self.db, self.limiter)
+        self.broadcasts = BroadcastEngine(self.db, self.limiter)
+        self.background_tasks = []
+        # Отложенные действия (возврат в админ-меню), отменяются следующим обновлением чата
+        self.followups = FollowUpScheduler()
+        # Время создания последних заявок для включения режима сводки
+        self.recent_applications = deque()
+        self.router = self.build_router()
     
     def is_admin(self, user_id: int) -> bool:
         """Проверка, является ли пользователь администратором"""
         return user_id in ADMIN_USER_IDS
     
+    def build_router(self) -> Router:
+        """Таблица маршрутов: кнопки меню, состояния пользователя и callback-кнопки"""
+        router = Router(self.is_admin)
+        
+        router.button(BUTTONS['apply'], self.start_application)
+        router.button(BUTTONS['admin_panel'], self.admin_panel, admin=True)
+        router.button("📊 Статистика", self.show_statistics, admin=True)
+        router.button("📨 Рассылка", self.start_broadcast, admin=True)
+        router.button("📋 Все заявки", self.view_applications, admin=True)
+        router.button("👥 Все пользователи", self.view_inactive_users, admin=True)
+        router.button("🗑️ Удалить заявку", self.start_delete_application, admin=True)
+        
+        # Во время подготовки рассылки любой текст — ее содержимое или время отправки
+        router.state('broadcast_message', self.send_broadcast_message, admin=True, capture=True)
+        router.state('broadcast_schedule', self.handle_broadcast_schedule, admin=True, capture=True)
+        router.state('application_fio', self.handle_fio_state)
+        router.state('application_phone', self.handle_phone_state)
+        router.state('application_info', self.handle_info_state)
+        router.state('delete_application', self.handle_delete_application, admin=True)
+        router.state('reply_application', self.handle_reply_message, int, admin=True)
+        
+        router.callback('reply', self.handle_reply_application, int)
+        router.callback('complete', self.handle_complete_application, int)
+        router.callback('delete', self.handle_delete_application_callback, int)
+        router.callback('open', self.handle_open_application, int)
+        router.callback('apps', self.handle_applications_page, str, int, str)
+        router.callback('digest', self.handle_digest_page, int, int)
+        router.callback('segment', self.handle_broadcast_segment, str)
+        router.callback('bsched', self.handle_broadcast_schedule_choice, int)
+        router.callback('bstop', self.handle_stop_broadcast, int)
+        router.callback('bcancel', self.handle_cancel_broadcast, legacy='cancel_broadcast')
+        return router
+    
+    def return_to_admin_panel(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                              delay: float = ADMIN_MENU_RETURN_DELAY, send_new: bool = False):
+        """Возврат в админ-меню после паузы без ожидания в обработчике.
+        Отменяется, если администратор за это время сделал что-то еще."""
+        panel = self.send_admin_panel_message if send_new else self.admin_panel
+        self.followups.schedule(update.effective_chat.id, delay, panel, update, context)
+    
     async def show_main_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать главное меню"""
         user = update.effective_user
         
-        # Создаем клавиатуру
-        keyboard = [
-            [KeyboardButton(BUTTONS['apply'])]
-        ]
-        
-        if self.is_admin(user.id):
-            keyboard.append([KeyboardButton(BUTTONS['admin_panel'])])
-        
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        reply_markup = main_menu_keyboard(self.is_admin(user.id))
         
         await update.message.reply_text(
             MESSAGES['welcome'],
@@ -51,15 +114,7 @@ class TelegramBot:
         """Показать главное меню без приветственного сообщения"""
         user = update.effective_user
         
-        # Создаем клавиатуру
-        keyboard = [
-            [KeyboardButton(BUTTONS['apply'])]
-        ]
-        
-        if self.is_admin(user.id):
-            keyboard.append([KeyboardButton(BUTTONS['admin_panel'])])
-        
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        reply_markup = main_menu_keyboard(self.is_admin(user.id))
         
         await update.message.reply_text(
             "Выберите действие:",
@@ -70,15 +125,7 @@ class TelegramBot:
         """Показать главное меню с кастомным сообщением"""
         user = update.effective_user
         
-        # Создаем клавиатуру
-        keyboard = [
-            [KeyboardButton(BUTTONS['apply'])]
-        ]
-        
-        if self.is_admin(user.id):
-            keyboard.append([KeyboardButton(BUTTONS['admin_panel'])])
-        
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        reply_markup = main_menu_keyboard(self.is_admin(user.id))
         
         await update.message.reply_text(
             message,
@@ -88,257 +135,212 @@ class TelegramBot:
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
         user = update.effective_user
+        self.followups.cancel(update.effective_chat.id)
         
-        # Добавляем пользователя в базу данных
-        self.db.add_user(
-            telegram_id=user.id,
-            username=user.username,
-            first_name=user.first_name,
-            last_name=user.last_name
-        )
-        
-        # Очищаем состояние пользователя
-        self.db.clear_user_state(user.id)
-        
-        # Показываем главное меню
-        await self.show_main_menu(update, context)
+        async with self.db.unit_of_work(user.id) as uow:
+            context.uow = uow
+            
+            # Добавляем пользователя в базу данных
+            uow.add_user(
+                username=user.username,
+                first_name=user.first_name,
+                last_name=user.last_name
+            )
+            
+            # Очищаем состояние пользователя
+            uow.clear_state()
+            
+            # Показываем главное меню
+            await self.show_main_menu(update, context)
     
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик текстовых сообщений"""
-        user = update.effective_user
-        text = update.message.text
+        self.db.activity.touch(update.effective_user.id)
+        self.followups.cancel(update.effective_chat.id)
         
-        # Проверяем, является ли пользователь администратором
-        is_admin = self.is_admin(user.id)
-        
-        # Проверяем состояние пользователя для рассылки
-        state_data = self.db.get_user_state(user.id)
-        if state_data and state_data['state'] == 'broadcast_message':
-            await self.send_broadcast_message(update, context)
+        # Пользователь и состояние загружаются один раз, изменения записываются в конце обновления
+        async with self.db.unit_of_work(update.effective_user.id) as uow:
+            context.uow = uow
+            await self.dispatch_message(update, context)
+    
+    async def dispatch_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Маршрутизация текстового сообщения"""
+        match = self.router.resolve_message(
+            update.effective_user.id, update.message.text, context.uow.state_name, context.uow.state_ref_id
+        )
+        if match is None:
+            if self.router.button_denied(update.effective_user.id, update.message.text):
+                await update.message.reply_text("У вас нет прав доступа к этой функции.")
+                return
+            # Обработка случайных сообщений
+            await self.handle_random_message(update, context)
             return
         
-        # Обработка кнопок
-        if text == BUTTONS['apply']:
-            await self.start_application(update, context)
-        elif text == BUTTONS['admin_panel'] and is_admin:
-            await self.admin_panel(update, context)
-        elif text == "📊 Статистика" and is_admin:
-            await self.show_statistics(update, context)
-        elif text == "📨 Рассылка" and is_admin:
-            await self.start_broadcast(update, context)
-        elif text == "📋 Все заявки" and is_admin:
-            await self.view_applications(update, context)
-        elif text == "👥 Все пользователи" and is_admin:
-            await self.view_inactive_users(update, context)
-        elif text == "🗑️ Удалить заявку" and is_admin:
-            await self.start_delete_application(update, context)
-        else:
-            # Проверяем состояние пользователя для обработки формы заявки
-            state_data = self.db.get_user_state(user.id)
-            if state_data and state_data['state'] in ['application_fio', 'application_phone', 'application_info', 'delete_application']:
-                await self.handle_application_state(update, context)
-            elif state_data and state_data['state'].startswith('reply_application_'):
-                # Обработка ответа на заявку
-                await self.handle_application_state(update, context)
-            else:
-                # Обработка случайных сообщений
-                await self.handle_random_message(update, context)
+        route, args = match
+        await route.handler(update, context, *args)
     
     async def start_application(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Начало оформления заявки"""
-        user = update.effective_user
-        
-        # Очищаем предыдущее состояние
-        self.db.clear_user_state(user.id)
-        
-        # Сохраняем состояние пользователя
-        self.db.save_user_state(user.id, 'application_fio')
+        # Сохраняем состояние пользователя (предыдущее перезаписывается) и время начала
+        context.uow.save_state('application_fio', started_at=int(time.time()))
         
         await update.message.reply_text(MESSAGES['application_start'])
     
-    async def handle_application_state(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработка состояний формы заявки"""
-        user = update.effective_user
+    async def handle_fio_state(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Шаг анкеты: ФИО"""
         text = update.message.text
+        state_data = context.uow.state
         
-        # Получаем текущее состояние пользователя
-        state_data = self.db.get_user_state(user.id)
-        if not state_data:
-            return
-        
-        state = state_data['state']
-        
-        if state == 'application_fio':
-            # Сохраняем ФИО и переходим к телефону
-            if text and len(text.strip()) > 0:
-                import json
-                data = {'fio': text.strip()}
-                self.db.save_user_state(user.id, 'application_phone', json.dumps(data))
-                await update.message.reply_text(MESSAGES['application_phone'])
-            else:
-                await update.message.reply_text("Пожалуйста, введите ваше ФИО:")
-        
-        elif state == 'application_phone':
-            # Валидация номера телефона
-            if self.validate_phone(text):
-                import json
-                # Получаем ФИО из предыдущего состояния
-                fio_data = json.loads(state_data['data']) if state_data['data'] else {}
-                data = {
-                    'fio': fio_data.get('fio', user.first_name or user.username or "Пользователь"), 
-                    'phone': text.strip()
-                }
-                self.db.save_user_state(user.id, 'application_info', json.dumps(data))
-                await update.message.reply_text(MESSAGES['application_info'])
-            else:
-                await update.message.reply_text(
-                    "Пожалуйста, введите корректный номер телефона (например: +7 (999) 123 45 67 или +7 999 123 45 67)"
-                )
-        
-        elif state == 'application_info':
-            # Завершаем оформление заявки
-            if text and len(text.strip()) > 0:
-                await self.complete_application(update, context, text.strip())
-            else:
-                await update.message.reply_text("Пожалуйста, опишите ваши потребности:")
-        
-        elif state == 'delete_application':
-            # Обработка удаления заявки
-            await self.handle_delete_application(update, context, text)
+        # Сохраняем ФИО и переходим к телефону
+        if text and len(text.strip()) > 0:
+            context.uow.save_state('application_phone', fio=text.strip(), started_at=state_data['started_at'])
+            await update.message.reply_text(MESSAGES['application_phone'])
+        else:
+            await update.message.reply_text("Пожалуйста, введите ваше ФИО:")
+    
+    async def handle_phone_state(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Шаг анкеты: телефон"""
+        user = update.effective_user
+        text = update.message.text
+        state_data = context.uow.state
+        
+        # Валидация номера телефона
+        if self.validate_phone(text):
+            # ФИО и время начала переносятся из предыдущего состояния
+            context.uow.save_state(
+                'application_info',
+                fio=state_data['fio'] or user.first_name or user.username or "Пользователь",
+                phone=text.strip(),
+                started_at=state_data['started_at']
+            )
+            await update.message.reply_text(MESSAGES['application_info'])
+        else:
+            await update.message.reply_text(
+                "Пожалуйста, введите корректный номер телефона (например: +7 (999) 123 45 67 или +7 999 123 45 67)"
+            )
+    
+    async def handle_info_state(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Шаг анкеты: описание запроса"""
+        text = update.message.text
         
-        elif state.startswith('reply_application_'):
-            # Обработка ответа на заявку
-            await self.handle_reply_message(update, context, text, state)
+        # Завершаем оформление заявки
+        if text and len(text.strip()) > 0:
+            await self.complete_application(update, context, text.strip())
+        else:
+            await update.message.reply_text("Пожалуйста, опишите ваши потребности:")
     
     async def handle_random_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка случайных сообщений"""
-        user = update.effective_user
-        
         # Очищаем состояние пользователя
-        self.db.clear_user_state(user.id)
+        context.uow.clear_state()
         
         # Показываем стартовое меню с сообщением о случайном вводе
         await self.show_main_menu_with_message(update, context, "❓ Не нашёл подходящий вариант. Открою стартовое меню 📋")
     
-    async def handle_reply_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, state: str):
-        """Обработка ответа на заявку"""
-        user = update.effective_user
-        
-        if not self.is_admin(user.id):
-            return
-        
-        # Извлекаем ID заявки из состояния
-        app_id = int(state.split('_')[-1])
+    async def handle_reply_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, app_id: int):
+        """Обработка ответа на заявку (app_id — ref_id состояния reply_application)"""
+        text = update.message.text
         
-        # Получаем данные заявки
-        applications = self.db.get_applications()
-        app = next((a for a in applications if a['id'] == app_id), None)
+        # Получаем данные заявки вместе с telegram_id пользователя
+        app = await self.db.get_application(app_id)
         
         if not app:
             await update.message.reply_text("❌ Заявка не найдена.")
             return
         
-        # Получаем telegram_id пользователя
-        user_data = self.db.get_user_by_id(app['user_id'])
-        telegram_id = user_data.get('telegram_id')
+        telegram_id = app.get('telegram_id')
         
         if not telegram_id:
             await update.message.reply_text("❌ Не удалось найти пользователя для отправки ответа.")
             return
         
-        # Отправляем ответ пользователю
+        # Ставим ответ в очередь, меняем статус заявки на "Выполнена" и очищаем состояние одной транзакцией
         try:
-            await context.bot.send_message(
-                chat_id=telegram_id,
-                text=f"💬 **Ответ от администратора на вашу заявку #{app_id}:**\n\n{text}",
-                parse_mode=ParseMode.MARKDOWN
-            )
-            
-            # Меняем статус заявки на "Выполнена"
-            success = self.db.update_application_status(app_id, 'Выполнена')
+            # Текст администратора отправляется без разметки: в нем могут быть любые символы
+            context.uow.enqueue(telegram_id, PRIORITY_REPLY, {
+                'text': f"💬 Ответ от администратора на вашу заявку #{app_id}:\n\n{text}"
+            })
+            status_index = context.uow.update_application_status(app_id, 'Выполнена')
+            context.uow.clear_state()
+            success = (await self.db.flush(context.uow))[status_index]
+            invalidate_application_card(app_id)
             if success:
                 logger.info(f"Статус заявки {app_id} изменен на 'Выполнена'")
             else:
                 logger.warning(f"Не удалось изменить статус заявки {app_id}")
             
-            await update.message.reply_text(f"✅ Ответ отправлен пользователю заявки #{app_id}. Статус изменен на 'Выполнена'.")
-            
-            # Очищаем состояние
-            self.db.clear_user_state(user.id)
+            await update.message.reply_text(
+                f"✅ Ответ пользователю заявки #{app_id} поставлен в очередь отправки. Статус изменен на 'Выполнена'.\n"
+                "Если ответ не удастся доставить, придет уведомление."
+            )
             
             # Возвращаемся в админ-меню
-            await asyncio.sleep(2)
-            await self.admin_panel(update, context)
+            self.return_to_admin_panel(update, context)
             
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка отправки ответа: {e}")
             # Очищаем состояние даже при ошибке
-            self.db.clear_user_state(user.id)
+            context.uow.clear_state()
     
-    async def handle_delete_application(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    async def handle_delete_application(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка удаления заявки"""
-        user = update.effective_user
-        
-        if not self.is_admin(user.id):
-            return
+        text = update.message.text
         
         try:
             # Пытаемся получить номер заявки
             app_id = int(text.strip())
             
             # Проверяем, существует ли заявка
-            applications = self.db.get_applications()
-            if not any(app['id'] == app_id for app in applications):
+            if not await self.db.application_exists(app_id):
                 await update.message.reply_text("❌ Заявка с таким номером не найдена.")
                 return
             
-            # Удаляем заявку
-            success = self.db.delete_application(app_id)
+            # Удаляем заявку и очищаем состояние пользователя одной транзакцией
+            context.uow.delete_application(app_id)
+            context.uow.clear_state()
+            success = (await self.db.flush(context.uow))[0]
             
             if success:
+                invalidate_application_card(app_id)
                 await update.message.reply_text(f"✅ Заявка #{app_id} успешно удалена!")
             else:
                 await update.message.reply_text("❌ Ошибка при удалении заявки.")
             
-            # Очищаем состояние пользователя
-            self.db.clear_user_state(user.id)
-            
         except ValueError:
             await update.message.reply_text("❌ Пожалуйста, введите корректный номер заявки (только цифры).")
     
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик callback-кнопок"""
+        self.db.activity.touch(update.effective_user.id)
+        self.followups.cancel(update.effective_chat.id)
+        
+        async with self.db.unit_of_work(update.effective_user.id) as uow:
+            context.uow = uow
+            await self.dispatch_callback(update, context)
+    
+    async def dispatch_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Маршрутизация callback-кнопки"""
         query = update.callback_query
-        user = update.effective_user
         
-        if not self.is_admin(user.id):
+        match = self.router.resolve_callback(query.data)
+        if not self.router.callback_allowed(match, update.effective_user.id):
             await query.answer("У вас нет прав доступа к этой функции.")
             return
         
         await query.answer()
-        
-        data = query.data
-        
-        if data == "cancel_broadcast":
-            await self.handle_cancel_broadcast(update, context)
+        if match is None:
+            # Неизвестные и поврежденные данные администратора просто подтверждаем
             return
         
-        action, app_id = data.split('_', 1)
-        app_id = int(app_id)
-        
-        if action == "reply":
-            await self.handle_reply_application(update, context, app_id)
-        elif action == "complete":
-            await self.handle_complete_application(update, context, app_id)
-        elif action == "delete":
-            await self.handle_delete_application_callback(update, context, app_id)
+        route, args = match
+        await route.handler(update, context, *args)
     
     async def handle_reply_application(self, update: Update, context: ContextTypes.DEFAULT_TYPE, app_id: int):
         """Обработка кнопки 'Ответить'"""
         query = update.callback_query
         
         # Сохраняем состояние для ответа на заявку
-        self.db.save_user_state(update.effective_user.id, f'reply_application_{app_id}')
+        context.uow.save_state('reply_application', ref_id=app_id)
         
         await query.edit_message_text(
             f"💬 **Ответ на заявку #{app_id}**\n\nВведите ваш ответ:",
@@ -350,16 +352,16 @@ class TelegramBot:
         query = update.callback_query
         
         # Обновляем статус заявки на 'Выполнена'
-        success = self.db.update_application_status(app_id, 'Выполнена')
+        success = await self.db.update_application_status(app_id, 'Выполнена')
         
         if success:
+            invalidate_application_card(app_id)
             await query.edit_message_text(
                 f"✅ **Заявка #{app_id} завершена!**\n\nСтатус изменен на 'Выполнена'",
                 parse_mode=ParseMode.MARKDOWN
             )
             # Возвращаемся в админ-меню
-            await asyncio.sleep(2)
-            await self.admin_panel(update, context)
+            self.return_to_admin_panel(update, context)
         else:
             await query.answer("❌ Ошибка при обновлении статуса заявки.")
     
@@ -368,16 +370,16 @@ class TelegramBot:
         query = update.callback_query
         
         # Удаляем заявку
-        success = self.db.delete_application(app_id)
+        success = await self.db.delete_application(app_id)
         
         if success:
+            invalidate_application_card(app_id)
             await query.edit_message_text(
                 f"🗑️ **Заявка #{app_id} удалена!**",
                 parse_mode=ParseMode.MARKDOWN
             )
             # Отправляем сообщение с панелью администратора
-            await asyncio.sleep(1)
-            await self.send_admin_panel_message(update, context)
+            self.return_to_admin_panel(update, context, delay=1, send_new=True)
         else:
             await query.answer("❌ Ошибка при удалении заявки.")
     
@@ -387,54 +389,41 @@ class TelegramBot:
         
         try:
             # Получаем данные из состояний
-            phone_state = self.db.get_user_state(user.id)
+            phone_state = context.uow.state
             if not phone_state or phone_state['state'] != 'application_info':
                 await update.message.reply_text("❌ Произошла ошибка. Начните оформление заявки заново.")
                 return
             
-            # Парсим данные из JSON
-            import json
-            try:
-                data = json.loads(phone_state['data'])
-                fio = data.get('fio', user.first_name or user.username or "Пользователь")
-                phone = data.get('phone', '')
-            except (json.JSONDecodeError, KeyError) as e:
-                logger.error(f"Ошибка парсинга данных заявки: {e}")
-                await update.message.reply_text("❌ Произошла ошибка. Начните оформление заявки заново.")
-                return
+            fio = phone_state['fio'] or user.first_name or user.username or "Пользователь"
+            phone = phone_state['phone'] or ''
+            started_at = phone_state['started_at']
             
             # Получаем данные пользователя
-            user_data = self.db.get_user(user.id)
+            user_data = context.uow.user
             if not user_data:
                 await update.message.reply_text("❌ Пользователь не найден. Начните оформление заявки заново.")
                 return
             
-            # Сохраняем заявку
-            success = self.db.add_application(
-                user_id=user_data['id'],
+            # Сохраняем заявку, уведомления администраторам и очищаем состояние одной транзакцией
+            app_index = context.uow.add_application(
                 name=fio,
                 phone=phone,
                 additional_info=additional_info,
                 status='Новая'
             )
+            self.notify_admin_new_application(update, context, app_index)
+            context.uow.clear_state()
+            if started_at:
+                # Время заполнения формы для аналитики
+                context.uow.record_metric(Database.completion_metric(time.time() - started_at))
+            app = (await self.db.flush(context.uow))[app_index]
             
-            if success:
-                # Получаем ID только что созданной заявки
-                applications = self.db.get_applications()
-                if applications:
-                    new_app_id = max(app['id'] for app in applications)
-                else:
-                    new_app_id = 1
-                
-                # Очищаем состояние пользователя
-                self.db.clear_user_state(user.id)
+            if app:
+                new_app_id = app['id']
                 
                 # Уведомляем пользователя
                 await update.message.reply_text("✅ " + MESSAGES['application_success'])
                 
-                # Уведомляем администратора с ID конкретной заявки
-                await self.notify_admin_new_application(update, context, fio, phone, additional_info, new_app_id)
-                
                 # Показываем главное меню без приветственного сообщения
                 await self.show_main_menu_silent(update, context)
                 
@@ -447,7 +436,7 @@ class TelegramBot:
             logger.error(f"Ошибка в complete_application: {e}")
             await update.message.reply_text("❌ Произошла ошибка. Попробуйте еще раз.")
             # Очищаем состояние при ошибке
-            self.db.clear_user_state(user.id)
+            context.uow.clear_state()
     
     def validate_phone(self, phone: str) -> bool:
         """Валидация номера телефона"""
@@ -479,16 +468,6 @@ class TelegramBot:
         
         return clean_valid or original_valid
     
-    def escape_markdown(self, text: str) -> str:
-        """Экранирование специальных символов Markdown"""
-        if not text:
-            return text
-        # Экранируем специальные символы Markdown
-        escape_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-        for char in escape_chars:
-            text = text.replace(char, f'\\{char}')
-        return text
-    
     async def send_admin_panel_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Отправка сообщения с панелью администратора"""
         user = update.effective_user
@@ -496,46 +475,23 @@ class TelegramBot:
         if not self.is_admin(user.id):
             return
         
-        keyboard = [
-            [KeyboardButton("📊 Статистика"), KeyboardButton("📨 Рассылка")],
-            [KeyboardButton("📋 Все заявки"), KeyboardButton("👥 Все пользователи")],
-            [KeyboardButton("🗑️ Удалить заявку")]
-        ]
-        
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        
         # Отправляем новое сообщение с панелью администратора
         logger.info(f"send_admin_panel_message: отправляем в чат {update.effective_chat.id}")
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text="🔧 **Панель администратора**\n\nВыберите действие:",
-            reply_markup=reply_markup,
+            text=ADMIN_PANEL_TEXT,
+            reply_markup=ADMIN_PANEL_KEYBOARD,
             parse_mode=ParseMode.MARKDOWN
         )
     
     async def admin_panel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Панель администратора"""
-        user = update.effective_user
-        
-        if not self.is_admin(user.id):
-            if update.message:
-                await update.message.reply_text("У вас нет прав доступа к админ-панели.")
-            return
-        
-        keyboard = [
-            [KeyboardButton("📊 Статистика"), KeyboardButton("📨 Рассылка")],
-            [KeyboardButton("📋 Все заявки"), KeyboardButton("👥 Все пользователи")],
-            [KeyboardButton("🗑️ Удалить заявку")]
-        ]
-        
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        
         # Проверяем, есть ли message (для callback-запросов может не быть)
         if update.message:
             logger.info("admin_panel: отправляем через update.message.reply_text")
             await update.message.reply_text(
-                "🔧 **Панель администратора**\n\nВыберите действие:",
-                reply_markup=reply_markup,
+                ADMIN_PANEL_TEXT,
+                reply_markup=ADMIN_PANEL_KEYBOARD,
                 parse_mode=ParseMode.MARKDOWN
             )
         else:
@@ -543,20 +499,16 @@ class TelegramBot:
             logger.info(f"admin_panel: отправляем через context.bot.send_message в чат {update.effective_chat.id}")
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
-                text="🔧 **Панель администратора**\n\nВыберите действие:",
-                reply_markup=reply_markup,
+                text=ADMIN_PANEL_TEXT,
+                reply_markup=ADMIN_PANEL_KEYBOARD,
                 parse_mode=ParseMode.MARKDOWN
             )
     
     async def start_delete_application(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Начало удаления заявки"""
-        user = update.effective_user
-        
-        if not self.is_admin(user.id):
-            return
-        
-        # Получаем все заявки
-        applications = self.db.get_applications()
+        # Первая страница заявок и общее число по счетчику
+        page = await self.db.get_applications_page(limit=10)
+        applications = page['applications']
         
         if not applications:
             await update.message.reply_text("❌ Заявок для удаления нет.")
@@ -565,171 +517,82 @@ class TelegramBot:
         # Показываем список заявок для удаления
         message = "🗑️ Выберите заявку для удаления:\n\n"
         
-        for i, app in enumerate(applications[:10], 1):  # Показываем первые 10
+        for i, app in enumerate(applications, 1):
             message += f"{i}. Заявка #{app['id']}\n"
             message += f"   👤 {app['name']}\n"
             message += f"   📞 {app['phone']}\n"
             message += f"   📅 {app['created_at']}\n\n"
         
-        if len(applications) > 10:
-            message += f"... и еще {len(applications) - 10} заявок\n\n"
+        if page['has_older']:
+            total = await self.db.get_application_count()
+            message += f"... и еще {max(total - len(applications), 0)} заявок\n\n"
         
         message += "Введите номер заявки для удаления:"
         
         # Сохраняем состояние для обработки номера заявки
-        self.db.save_user_state(user.id, 'delete_application')
+        context.uow.save_state('delete_application')
         
         await update.message.reply_text(message)
     
     async def view_applications(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Просмотр заявок"""
-        user = update.effective_user
+        """Просмотр заявок: первая страница списка, дальше страницы листаются в том же сообщении"""
+        page = await self.db.get_applications_page(limit=APPLICATIONS_PAGE_SIZE)
         
-        if not self.is_admin(user.id):
-            await update.message.reply_text("❌ У вас нет прав доступа к этой функции.")
+        if not page['applications']:
+            await update.message.reply_text("📋 Заявок пока нет.")
+            # Возвращаемся в админ-меню
+            self.return_to_admin_panel(update, context)
             return
         
-        try:
-            applications = self.db.get_applications()
-            
-            if not applications:
-                await update.message.reply_text("📋 Заявок пока нет.")
-                # Возвращаемся в админ-меню
-                await asyncio.sleep(2)
-                await self.admin_panel(update, context)
-                return
-            
-            # Отправляем общее сообщение о количестве заявок
-            await update.message.reply_text(f"📋 **Все заявки ({len(applications)}):**\n")
-            
-            # Отправляем заявки по одной
-            for i, app in enumerate(applications, 1):
-                try:
-                    await self.send_application_info(update, context, app)
-                    # Увеличенная задержка между заявками для предотвращения таймаутов
-                    if i < len(applications):
-                        await asyncio.sleep(2)
-                except Exception as e:
-                    logger.error(f"Ошибка отправки заявки {app['id']}: {e}")
-                    continue
-            
-            # Возвращаемся в админ-меню
-            await asyncio.sleep(2)
-            await self.admin_panel(update, context)
-            
-        except Exception as e:
-            logger.error(f"Ошибка в view_applications: {e}")
-            await update.message.reply_text("❌ Произошла ошибка при загрузке заявок.")
-            # Возвращаемся в админ-меню
-            await asyncio.sleep(2)
-            await self.admin_panel(update, context)
+        text, keyboard = self.build_applications_page(page)
+        await update.message.reply_text(text, reply_markup=keyboard)
     
-    async def send_application_info(self, update: Update, context: ContextTypes.DEFAULT_TYPE, app: dict):
-        """Отправка информации о заявке БЕЗ кнопок"""
+    def build_applications_page(self, page: dict):
+        """Страница списка заявок: краткие строки, кнопки открытия и переключение страниц"""
+        applications = page['applications']
+        lines = ["📋 Заявки (сначала новые):", ""]
+        for app in applications:
+            lines.append(f"#{app['id']} {status_emoji(app.get('status'))} {app['name'][:40]} · {app['phone']} · {app['created_at'][:16]}")
+        
+        buttons = [InlineKeyboardButton(f"📂 #{app['id']}", callback_data=callback_data("open", app['id'])) for app in applications]
+        keyboard = [buttons[i:i + 5] for i in range(0, len(buttons), 5)]
+        
+        # Курсор — ключ (created_at, id) крайней заявки страницы
+        navigation = []
+        if page['has_newer']:
+            first = applications[0]
+            navigation.append(InlineKeyboardButton("◀️", callback_data=callback_data("apps", "newer", first['id'], first['created_at'])))
+        if page['has_older']:
+            last = applications[-1]
+            navigation.append(InlineKeyboardButton("▶️", callback_data=callback_data("apps", "older", last['id'], last['created_at'])))
+        if navigation:
+            keyboard.append(navigation)
+        return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+    
+    async def handle_applications_page(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                       direction: str, app_id: int, created_at: str):
+        """Переключение страницы списка заявок: один запрос и одно редактирование сообщения.
+        Курсор — (created_at, id) крайней заявки текущей страницы."""
+        query = update.callback_query
+        page = await self.db.get_applications_page((created_at, app_id), direction == "older", APPLICATIONS_PAGE_SIZE)
+        if not page['applications']:
+            # Заявки за курсором удалены — возвращаемся к началу списка
+            page = await self.db.get_applications_page(limit=APPLICATIONS_PAGE_SIZE)
+        if not page['applications']:
+            await query.edit_message_text("📋 Заявок пока нет.")
+            return
+        
+        text, keyboard = self.build_applications_page(page)
         try:
-            # Получаем данные пользователя
-            user_data = self.db.get_user_by_id(app['user_id'])
-            
-            # Экранируем данные для Markdown
-            first_name = self.escape_markdown(user_data.get('first_name', 'Не указан'))
-            username = self.escape_markdown(user_data.get('username', 'username'))
-            name = self.escape_markdown(app['name'])
-            phone = self.escape_markdown(app['phone'])
-            additional_info = self.escape_markdown(app['additional_info'])
-            
-            # Формируем сообщение
-            message = f"📧 **Заявка #{app['id']}**\n\n"
-            message += f"👤 **Пользователь:** {first_name} (@{username})\n"
-            message += f"🔥 **ФИО:** {name}\n"
-            message += f"📞 **Телефон:** {phone}\n"
-            message += f"💬 **Запрос:** {additional_info}\n"
-            message += f"🕐 **Дата:** {app['created_at']}\n"
-            status = app.get('status', 'Новая')
-            status_emoji = "🆕" if status == 'Новая' else "✅" if status == 'Выполнена' else "❓"
-            message += f"📊 **Статус:** {status_emoji} {status}"
-            
-            # Попытка отправки с обработкой таймаута
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    await context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=message,
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                    break  # Успешно отправлено
-                except Exception as timeout_error:
-                    if attempt < max_retries - 1:
-                        logger.warning(f"Попытка {attempt + 1} неудачна, повторяем: {timeout_error}")
-                        await asyncio.sleep(1)  # Ждем перед повтором
-                    else:
-                        raise timeout_error  # Последняя попытка неудачна
-            
-        except Exception as e:
-            logger.error(f"Ошибка отправки информации о заявке {app.get('id', 'Unknown')}: {e}")
-            # Отправляем упрощенное сообщение без Markdown
-            try:
-                simple_message = f"📧 Заявка #{app['id']}\n"
-                simple_message += f"👤 Пользователь: {user_data.get('first_name', 'Не указан')}\n"
-                simple_message += f"🔥 ФИО: {app['name']}\n"
-                simple_message += f"📞 Телефон: {app['phone']}\n"
-                simple_message += f"💬 Запрос: {app['additional_info']}\n"
-                simple_message += f"🕐 Дата: {app['created_at']}\n"
-                simple_message += f"📊 Статус: {app.get('status', 'Новая')}"
-                
-                # Попытка отправки простого сообщения с обработкой таймаута
-                max_retries = 3
-                for attempt in range(max_retries):
-                    try:
-                        await context.bot.send_message(
-                            chat_id=update.effective_chat.id,
-                            text=simple_message
-                        )
-                        break  # Успешно отправлено
-                    except Exception as timeout_error:
-                        if attempt < max_retries - 1:
-                            logger.warning(f"Попытка {attempt + 1} отправки простого сообщения неудачна: {timeout_error}")
-                            await asyncio.sleep(1)  # Ждем перед повтором
-                        else:
-                            logger.error(f"Не удалось отправить простое сообщение после {max_retries} попыток: {timeout_error}")
-            except Exception as e2:
-                logger.error(f"Критическая ошибка отправки заявки: {e2}")
+            await query.edit_message_text(text, reply_markup=keyboard)
+        except BadRequest as e:
+            # Страница не изменилась
+            logger.debug(f"Страница заявок не обновлена: {e}")
     
     async def send_application_card(self, update: Update, context: ContextTypes.DEFAULT_TYPE, app: dict, is_reply: bool = True):
         """Отправка карточки заявки с кнопками"""
-        # Получаем данные пользователя
-        user_data = self.db.get_user_by_id(app['user_id'])
-        
-        # Экранируем данные для Markdown
-        first_name = self.escape_markdown(user_data.get('first_name', 'Не указан'))
-        username = self.escape_markdown(user_data.get('username', 'username'))
-        name = self.escape_markdown(app['name'])
-        phone = self.escape_markdown(app['phone'])
-        additional_info = self.escape_markdown(app['additional_info'])
-        
-        # Формируем сообщение в стиле скриншота
-        message = f"📧 **Заявка #{app['id']}**\n\n"
-        message += f"👤 **Пользователь:** {first_name} (@{username})\n"
-        message += f"🔥 **ФИО:** {name}\n"
-        message += f"📞 **Телефон:** {phone}\n"
-        message += f"💬 **Запрос:** {additional_info}\n"
-        message += f"🕐 **Дата:** {app['created_at']}\n"
-        status = app.get('status', 'Новая')
-        status_emoji = "🆕" if status == 'Новая' else "✅" if status == 'Выполнена' else "❓"
-        message += f"📊 **Статус:** {status_emoji} {status}"
-        
-        # Создаем inline клавиатуру
-        keyboard = [
-            [
-                InlineKeyboardButton("💬 Ответить", callback_data=f"reply_{app['id']}"),
-                InlineKeyboardButton("✅ Завершить", callback_data=f"complete_{app['id']}")
-            ],
-            [
-                InlineKeyboardButton("🗑️ Удалить", callback_data=f"delete_{app['id']}")
-            ]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        # Данные пользователя приходят вместе с заявкой (get_application), отдельный запрос не нужен
+        message, reply_markup = render_application_card(app, app.get('first_name'), app.get('username'))
         
         if is_reply:
             await update.message.reply_text(
@@ -747,43 +610,26 @@ class TelegramBot:
     
     async def view_inactive_users(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Просмотр пользователей без заявок"""
-        user = update.effective_user
-        
-        if not self.is_admin(user.id):
-            return
-        
-        inactive_users = self.db.get_users_without_applications()
+        # Сегмент "без заявок" читается страницами по индексу, записи склеиваются
+        # в сообщения до лимита длины, длинный список отправляется файлом
+        count = await send_listing(
+            context.bot, update.effective_chat.id,
+            header="👥 **Пользователи без заявок:**\n\n",
+            records=self.inactive_user_records(),
+            filename="users_without_applications.txt",
+            caption="👥 Пользователи без заявок"
+        )
         
-        if not inactive_users:
+        if not count:
             await update.message.reply_text("Все пользователи оформили заявки! 🎉")
             return
         
-        # Отправляем пользователей по 5 штук
-        for i in range(0, len(inactive_users), 5):
-            batch = inactive_users[i:i+5]
-            message = "👥 **Пользователи без заявок:**\n\n"
-            
-            for user_data in batch:
-                username = f"@{user_data['username']}" if user_data['username'] else "не указан"
-                first_name = user_data['first_name'] or "Не указано"
-                last_activity = user_data['last_seen'] or user_data['last_activity']
-                
-                # Используем функцию экранирования
-                first_name = self.escape_markdown(first_name)
-                username = self.escape_markdown(username)
-                
-                message += f"**ID:** {user_data['telegram_id']}\n"
-                message += f"**Имя:** {first_name}\n"
-                message += f"**Username:** {username}\n"
-                message += f"**Последняя активность:** {last_activity}\n"
-                message += "─" * 30 + "\n\n"
-            
-            await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
-        
-        # Отправляем статистику
-        total_users = len(self.db.get_all_users())
-        users_with_apps = len(self.db.get_applications())
-        inactive_count = len(inactive_users)
+        # Отправляем статистику из счетчиков
+        stats = await self.db.get_stats()
+        total_users = stats['users_total']
+        users_with_apps = stats['users_with_applications']
+        inactive_count = total_users - users_with_apps
+        conversion = users_with_apps / total_users * 100 if total_users else 0
         
         stats_message = f"""
 📊 **Статистика активности:**
@@ -791,175 +637,438 @@ class TelegramBot:
 👥 **Всего пользователей:** {total_users}
 📋 **С заявками:** {users_with_apps}
 ❌ **Без заявок:** {inactive_count}
-📈 **Конверсия:** {(users_with_apps/total_users*100):.1f}% (если есть пользователи)
+📈 **Конверсия:** {conversion:.1f}%
         """
         
         await update.message.reply_text(stats_message, parse_mode=ParseMode.MARKDOWN)
     
+    async def inactive_user_records(self):
+        """Записи списка пользователей без заявок: (Markdown для сообщения, текст для файла)"""
+        after = None
+        while True:
+            users = await self.db.get_segment_users('no_application', after=after, limit=LISTING_BATCH_SIZE)
+            for user_data in users:
+                username = f"@{user_data['username']}" if user_data['username'] else "не указан"
+                first_name = user_data['first_name'] or "Не указано"
+                last_activity = user_data['last_seen'] or user_data['last_activity']
+                
+                formatted = f"**ID:** {user_data['telegram_id']}\n"
+                formatted += f"**Имя:** {escape_markdown(first_name)}\n"
+                formatted += f"**Username:** {escape_markdown(username)}\n"
+                formatted += f"**Последняя активность:** {last_activity}\n"
+                formatted += "─" * 30 + "\n\n"
+                
+                text = f"ID: {user_data['telegram_id']}\nИмя: {first_name}\nUsername: {username}\n"
+                text += f"Последняя активность: {last_activity}\n\n"
+                yield formatted, text
+            
+            if len(users) < LISTING_BATCH_SIZE:
+                return
+            after = users[-1]['telegram_id']
+    
     async def start_broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Начало рассылки"""
-        user = update.effective_user
+        context.uow.save_state('broadcast_message', draft=json.dumps({'segment': 'all'}))
+        await update.message.reply_text(
+            "📢 **Рассылка**\n\n"
+            f"Получатели: {SEGMENTS['all']}\n"
+            "Выберите сегмент или сразу введите сообщение для рассылки "
+            "(можно отправить фото, документ или альбом с подписью):",
+            reply_markup=BROADCAST_SEGMENT_KEYBOARD,
+            parse_mode=ParseMode.MARKDOWN
+        )
+    
+    async def handle_broadcast_segment(self, update: Update, context: ContextTypes.DEFAULT_TYPE, segment: str):
+        """Выбор сегмента получателей рассылки"""
+        query = update.callback_query
         
-        if not self.is_admin(user.id):
+        if segment not in SEGMENTS or context.uow.state_name != 'broadcast_message':
             return
         
-        # Создаем клавиатуру с кнопкой отмены
-        keyboard = [
-            [InlineKeyboardButton("❌ Отменить рассылку", callback_data="cancel_broadcast")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        context.uow.save_state('broadcast_message', draft=json.dumps({'segment': segment}))
+        count = await self.db.count_segment(segment)
         
-        self.db.save_user_state(user.id, 'broadcast_message')
-        await update.message.reply_text(
-            "📢 **Рассылка**\n\nВведите сообщение для рассылки:",
-            reply_markup=reply_markup,
+        await query.edit_message_text(
+            "📢 **Рассылка**\n\n"
+            f"Получатели: {SEGMENTS[segment]} ({count})\n"
+            "Введите сообщение для рассылки или отправьте фото, документ или альбом:",
+            reply_markup=BROADCAST_SEGMENT_KEYBOARD,
             parse_mode=ParseMode.MARKDOWN
         )
     
     async def show_statistics(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показ статистики"""
-        user = update.effective_user
-        
-        if not self.is_admin(user.id):
-            return
-        
-        app_count = self.db.get_application_count()
-        users = self.db.get_all_users()
-        user_count = len(users)
+        stats = await self.db.get_stats()
+        by_status = "\n".join(
+            f"   • {status}: {count}" for status, count in sorted(stats['applications_by_status'].items())
+        )
         
         stats_message = f"""
 📊 **Статистика бота:**
 
-👥 **Пользователи:** {user_count}
-📋 **Заявки:** {app_count}
+👥 **Пользователи:** {stats['users_total']}
+📋 **Заявки:** {stats['applications_total']}
+{by_status}
 📅 **Дата:** {datetime.now().strftime('%d.%m.%Y %H:%M')}
         """
         
+        # Воронка заявок из дневных агрегатов
+        stats_message += self.format_funnel("за сутки", await self.db.get_funnel(1))
+        stats_message += self.format_funnel("за 7 дней", await self.db.get_funnel(7))
+        
+        # Сообщения и кнопки без маршрута с момента запуска бота
+        unmatched = self.router.unmatched
+        if unmatched:
+            stats_message += f"\n❔ **Без обработчика:** сообщений {unmatched['message']}, кнопок {unmatched['callback']}\n"
+        
         await update.message.reply_text(stats_message, parse_mode=ParseMode.MARKDOWN)
         
-        # Возвращаемся в админ-меню через 3 секунды
-        await asyncio.sleep(3)
-        await self.admin_panel(update, context)
+        # Возвращаемся в админ-меню, когда администратор успеет прочитать статистику
+        self.return_to_admin_panel(update, context, delay=ADMIN_MENU_RETURN_DELAY + 1)
     
-    async def notify_admin_new_application(self, update: Update, context: ContextTypes.DEFAULT_TYPE, 
-                                         name: str, phone: str, additional_info: str, app_id: int = None):
-        """Уведомление администраторов о новой заявке"""
-        try:
-            user = update.effective_user
-            
-            # Получаем ID заявки
-            if app_id is not None:
-                new_app_id = app_id
-            else:
-                # Fallback: получаем ID последней заявки
-                applications = self.db.get_applications()
-                if applications:
-                    new_app_id = max(app['id'] for app in applications)
-                else:
-                    new_app_id = 1
-            
-            # Экранируем данные для Markdown
-            first_name = self.escape_markdown(user.first_name or 'Не указан')
-            username = self.escape_markdown(user.username or 'username')
-            name_escaped = self.escape_markdown(name)
-            phone_escaped = self.escape_markdown(phone)
-            additional_info_escaped = self.escape_markdown(additional_info or 'не указано')
-            
-            message = f"🆕 **Новая заявка!**\n\n"
-            message += f"📄 **Заявка #{new_app_id}**\n"
-            message += f"👤 **Пользователь:** {first_name} (@{username})\n"
-            message += f"🔥 **ФИО:** {name_escaped}\n"
-            message += f"📞 **Телефон:** {phone_escaped}\n"
-            message += f"💬 **Запрос:** {additional_info_escaped}\n"
-            message += f"🕐 **Дата:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-            message += f"📊 **Статус:** 🆕 Новая"
-            
-            # Создаем inline клавиатуру
-            keyboard = [
-                [
-                    InlineKeyboardButton("💬 Ответить", callback_data=f"reply_{new_app_id}"),
-                    InlineKeyboardButton("✅ Завершить", callback_data=f"complete_{new_app_id}")
-                ],
-                [
-                    InlineKeyboardButton("🗑️ Удалить", callback_data=f"delete_{new_app_id}")
-                ]
-            ]
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
+    def format_funnel(self, period: str, funnel: dict) -> str:
+        """Форматирование воронки заявок за период"""
+        started = funnel['form_started']
+        phone = funnel['form_phone']
+        info = funnel['form_info']
+        created = funnel['applications_created']
+        
+        median = funnel['completion_median']
+        if median is None:
+            median_text = "нет данных"
+        elif median > COMPLETION_BUCKETS[-1]:
+            median_text = f"более {COMPLETION_BUCKETS[-1] // 3600} ч"
+        elif median < 3600:
+            median_text = f"до {median // 60} мин"
+        else:
+            median_text = f"до {median // 3600} ч"
+        
+        message = f"\n📈 **Воронка {period}:**\n"
+        message += f"👤 Новые пользователи: {funnel['users_new']}\n"
+        message += f"📝 Начали заявку: {started}\n"
+        message += f"📞 Ввели ФИО: {phone} (брошено: {max(started - phone, 0)})\n"
+        message += f"💬 Ввели телефон: {info} (брошено: {max(phone - info, 0)})\n"
+        message += f"📋 Заявок создано: {created} (брошено: {max(info - created, 0)})\n"
+        message += f"✅ Выполнено: {funnel['applications_completed']}\n"
+        message += f"⏱ Медиана заполнения: {median_text}\n"
+        return message
+    
+    def notify_admin_new_application(self, update: Update, context: ContextTypes.DEFAULT_TYPE, app_index: int):
+        """Постановка уведомлений администраторам о новой заявке в очередь
+        (app_index — позиция add_application в единице работы)"""
+        user = update.effective_user
+        
+        # При большом потоке заявок уведомление откладывается до сводки
+        if self.admin_digest_active():
+            context.uow.add_to_admin_digest(app_index)
+            return
+        
+        def build(results) -> dict:
+            app = results[app_index]
+            message, keyboard = render_application_card(app, user.first_name, user.username, new=True)
             
-            # Отправляем уведомление всем администраторам
-            for admin_id in ADMIN_USER_IDS:
-                try:
-                    await context.bot.send_message(
-                        chat_id=admin_id,
-                        text=message,
-                        reply_markup=reply_markup,
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                    logger.info(f"Уведомление о заявке #{new_app_id} отправлено администратору {admin_id}")
-                except Exception as e:
-                    logger.error(f"Ошибка отправки уведомления о заявке #{new_app_id} администратору {admin_id}: {e}")
-                    
+            return {
+                'text': message,
+                'reply_markup': keyboard.to_dict(),
+                'parse_mode': ParseMode.MARKDOWN
+            }
+        
+        # Уведомление всем администраторам; текст строится в транзакции по созданной заявке
+        for admin_id in ADMIN_USER_IDS:
+            context.uow.enqueue(admin_id, PRIORITY_ADMIN, build)
+    
+    def admin_digest_active(self) -> bool:
+        """Учет новой заявки; True, если поток заявок выше порога и уведомления идут сводкой"""
+        if ADMIN_DIGEST_THRESHOLD <= 0:
+            return False
+        
+        now = time.monotonic()
+        self.recent_applications.append(now)
+        while self.recent_applications[0] < now - ADMIN_DIGEST_WINDOW:
+            self.recent_applications.popleft()
+        return len(self.recent_applications) > ADMIN_DIGEST_THRESHOLD
+    
+    async def run_admin_digest(self):
+        """Периодическая отправка сводки отложенных уведомлений о заявках"""
+        while True:
+            await asyncio.sleep(ADMIN_DIGEST_INTERVAL)
+            count = await self.db.flush_admin_digest(ADMIN_USER_IDS, PRIORITY_ADMIN, self.build_admin_digest)
+            if count:
+                logger.info(f"Сводка по {count} заявкам поставлена в очередь администраторам")
+    
+    def build_admin_digest(self, digest_id: int, applications: list) -> dict:
+        """Сообщение сводки: количество заявок и первая страница кнопок"""
+        pages = (len(applications) + ADMIN_DIGEST_PAGE_SIZE - 1) // ADMIN_DIGEST_PAGE_SIZE
+        text = (
+            f"📬 Новые заявки: {len(applications)} за последние {int(ADMIN_DIGEST_INTERVAL // 60)} мин.\n\n"
+            "Откройте заявку кнопкой ниже."
+        )
+        keyboard = self.admin_digest_keyboard(digest_id, applications[:ADMIN_DIGEST_PAGE_SIZE], 0, pages)
+        return {'text': text, 'reply_markup': keyboard.to_dict()}
+    
+    def admin_digest_keyboard(self, digest_id: int, applications: list, page: int, pages: int) -> InlineKeyboardMarkup:
+        """Страница сводки: заявки и переключение страниц"""
+        keyboard = [
+            [InlineKeyboardButton(f"#{app['id']} · {app['name']}", callback_data=callback_data("open", app['id']))]
+            for app in applications
+        ]
+        if pages > 1:
+            navigation = []
+            if page > 0:
+                navigation.append(InlineKeyboardButton("◀️", callback_data=callback_data("digest", digest_id, page - 1)))
+            navigation.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=callback_data("digest", digest_id, page)))
+            if page < pages - 1:
+                navigation.append(InlineKeyboardButton("▶️", callback_data=callback_data("digest", digest_id, page + 1)))
+            keyboard.append(navigation)
+        return InlineKeyboardMarkup(keyboard)
+    
+    async def handle_digest_page(self, update: Update, context: ContextTypes.DEFAULT_TYPE, digest_id: int, page: int):
+        """Переключение страницы сводки"""
+        application_ids = await self.db.get_admin_digest(digest_id)
+        pages = (len(application_ids) + ADMIN_DIGEST_PAGE_SIZE - 1) // ADMIN_DIGEST_PAGE_SIZE
+        if not 0 <= page < pages:
+            return
+        
+        page_ids = application_ids[page * ADMIN_DIGEST_PAGE_SIZE:(page + 1) * ADMIN_DIGEST_PAGE_SIZE]
+        applications = await self.db.get_applications_by_ids(page_ids)
+        try:
+            await update.callback_query.edit_message_reply_markup(
+                reply_markup=self.admin_digest_keyboard(digest_id, applications, page, pages)
+            )
         except Exception as e:
-            logger.error(f"Критическая ошибка в notify_admin_new_application: {e}")
+            # Повторное нажатие на текущую страницу не меняет клавиатуру
+            logger.debug(f"Страница сводки {digest_id} не обновлена: {e}")
+    
+    async def handle_open_application(self, update: Update, context: ContextTypes.DEFAULT_TYPE, app_id: int):
+        """Открытие карточки заявки из сводки или списка заявок"""
+        app = await self.db.get_application(app_id)
+        if not app:
+            await context.bot.send_message(chat_id=update.effective_chat.id, text="❌ Заявка не найдена.")
+            return
+        
+        await self.send_application_card(update, context, app, is_reply=False)
     
     async def send_broadcast_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Отправка сообщения рассылки"""
-        user = update.effective_user
+        """Получение текста рассылки и выбор времени отправки"""
         text = update.message.text
         
-        if not self.is_admin(user.id):
+        # Сегмент получателей из состояния
+        state_data = context.uow.state
+        segment = json.loads(state_data['draft']).get('segment', 'all') if state_data and state_data['draft'] else 'all'
+        
+        context.uow.save_state('broadcast_schedule', draft=json.dumps({'segment': segment, 'text': text}))
+        await self.ask_broadcast_schedule(update)
+    
+    async def handle_media(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик фото и документов (используются в рассылках)"""
+        self.db.activity.touch(update.effective_user.id)
+        self.followups.cancel(update.effective_chat.id)
+        
+        async with self.db.unit_of_work(update.effective_user.id) as uow:
+            context.uow = uow
+            if self.is_admin(update.effective_user.id) and uow.state_name in ('broadcast_message', 'broadcast_schedule'):
+                await self.handle_broadcast_media(update, context)
+    
+    def media_item(self, message) -> dict:
+        """Описание файла сообщения для рассылки"""
+        if message.photo:
+            # Самый большой из размеров фото
+            photo = message.photo[-1]
+            return {'type': 'photo', 'file_id': photo.file_id, 'file_unique_id': photo.file_unique_id}
+        return {
+            'type': 'document',
+            'file_id': message.document.file_id,
+            'file_unique_id': message.document.file_unique_id
+        }
+    
+    async def handle_broadcast_media(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Фото, документ или альбом для рассылки"""
+        message = update.message
+        item = self.media_item(message)
+        data = json.loads(context.uow.state['draft']) if context.uow.state['draft'] else {}
+        
+        if context.uow.state_name == 'broadcast_schedule':
+            # Остальные файлы альбома приходят отдельными сообщениями с тем же media_group_id
+            if message.media_group_id and data.get('media_group_id') == message.media_group_id:
+                data['media'].append(item)
+                data['text'] = data.get('text') or message.caption or ''
+                context.uow.save_state('broadcast_schedule', draft=json.dumps(data))
             return
         
-        # Получаем всех пользователей
-        users = self.db.get_all_users()
+        data.update({
+            'text': message.caption or '',
+            'media': [item],
+            'media_group_id': message.media_group_id
+        })
+        context.uow.save_state('broadcast_schedule', draft=json.dumps(data))
+        await self.ask_broadcast_schedule(update)
+    
+    async def ask_broadcast_schedule(self, update: Update):
+        """Вопрос о времени отправки рассылки"""
+        await update.message.reply_text(
+            "🕐 Когда отправить рассылку?\n\n"
+            "Выберите вариант или введите время начала и окно доставки, например:\n"
+            "10:00 2ч — начать в 10:00 и разослать за 2 часа\n"
+            "25.12 09:30 — отправить 25 декабря в 09:30\n"
+            "сейчас 30м — начать сейчас и разослать за 30 минут",
+            reply_markup=BROADCAST_SCHEDULE_KEYBOARD
+        )
+    
+    def parse_broadcast_schedule(self, text: str):
+        """Разбор времени рассылки: (локальное время начала или None, окно в секундах);
+        None, если формат не распознан"""
+        match = re.fullmatch(
+            r'(?:(сейчас)|(?:(\d{1,2})\.(\d{1,2})\s+)?(\d{1,2}):(\d{2}))(?:\s+(\d+)\s*(ч|м|h|m))?',
+            text.strip().lower()
+        )
+        if not match:
+            return None
+        now_word, day, month, hour, minute, amount, unit = match.groups()
+        spread = int(amount or 0) * (3600 if unit in ('ч', 'h') else 60)
+        if now_word:
+            return None, spread
+        
+        now = datetime.now()
+        try:
+            start = now.replace(hour=int(hour), minute=int(minute), second=0, microsecond=0)
+            if day:
+                start = start.replace(month=int(month), day=int(day))
+                if start < now:
+                    start = start.replace(year=start.year + 1)
+            elif start < now:
+                start += timedelta(days=1)
+        except ValueError:
+            return None
+        return start, spread
+    
+    async def handle_broadcast_schedule(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Ввод времени рассылки текстом"""
+        schedule = self.parse_broadcast_schedule(update.message.text)
+        if schedule is None:
+            await update.message.reply_text(
+                "❌ Не удалось распознать время. Пример: 10:00 2ч",
+                reply_markup=BROADCAST_SCHEDULE_KEYBOARD
+            )
+            return
         
-        if not users:
-            await update.message.reply_text("Нет пользователей для рассылки.")
+        start, spread = schedule
+        await self.schedule_broadcast(update, context, start, spread)
+    
+    async def handle_broadcast_schedule_choice(self, update: Update, context: ContextTypes.DEFAULT_TYPE, spread_minutes: int):
+        """Выбор времени рассылки кнопкой: сейчас, с окном доставки или без"""
+        if context.uow.state_name != 'broadcast_schedule':
             return
         
-        # Отправляем сообщение всем пользователям
-        sent_count = 0
-        failed_count = 0
-        
-        for user_data in users:
-            try:
-                await context.bot.send_message(
-                    chat_id=user_data['telegram_id'],
-                    text=text
-                )
-                sent_count += 1
-            except Exception as e:
-                logger.error(f"Ошибка отправки сообщения пользователю {user_data['telegram_id']}: {e}")
-                failed_count += 1
+        await update.callback_query.edit_message_reply_markup(reply_markup=None)
+        await self.schedule_broadcast(update, context, None, spread_minutes * 60)
+    
+    async def schedule_broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE, start: datetime, spread: int):
+        """Создание рассылки из состояния: немедленной, с окном доставки или отложенной"""
+        data = json.loads(context.uow.state['draft'])
+        
+        # Рассылка с окном доставки идет через планировщик, время хранится в UTC
+        if start is None and spread:
+            start = datetime.now()
+        scheduled_at = start.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S') if start else None
+        
+        # Запоминаем file_id, чтобы файл не загружался повторно
+        media = data.get('media')
+        await self.db.save_media_files(media)
+        
+        # Фиксируем рассылку, отправка идет в фоне
+        broadcast = await self.db.create_broadcast(
+            data['text'], data.get('segment', 'all'), admin_chat_id=update.effective_chat.id,
+            scheduled_at=scheduled_at, spread_seconds=spread, media=media
+        )
         
         # Очищаем состояние
-        self.db.clear_user_state(user.id)
+        context.uow.clear_state()
         
-        # Уведомляем администратора о результате
-        result_message = f"""
-📢 **Рассылка завершена!**
-
-✅ **Отправлено:** {sent_count}
-❌ **Ошибок:** {failed_count}
-📊 **Всего пользователей:** {len(users)}
-        """
+        if not broadcast:
+            await context.bot.send_message(chat_id=update.effective_chat.id, text="❌ Ошибка при создании рассылки.")
+            return
+        
+        if broadcast['status'] == 'scheduled':
+            window = f", доставка в течение {spread // 60} мин." if spread else ""
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text=f"🕐 Рассылка #{broadcast['id']} запланирована на {start.strftime('%d.%m %H:%M')}{window}",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("❌ Отменить рассылку", callback_data=callback_data("bstop", broadcast['id']))]
+                ])
+            )
+            return
+        
+        if broadcast['total_count'] == 0:
+            await self.db.update_broadcast(broadcast['id'], status='done')
+            await context.bot.send_message(chat_id=update.effective_chat.id, text="Нет пользователей для рассылки.")
+            return
+        
+        self.broadcasts.start(context.bot, broadcast['id'])
+    
+    async def handle_stop_broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE, broadcast_id: int):
+        """Остановка выполняющейся рассылки"""
+        query = update.callback_query
+        
+        if self.broadcasts.stop(broadcast_id):
+            return
         
-        await update.message.reply_text(result_message)
+        if await self.db.cancel_scheduled_broadcast(broadcast_id):
+            await query.edit_message_text(f"❌ Рассылка #{broadcast_id} отменена")
+        else:
+            await query.edit_message_reply_markup(reply_markup=None)
     
     async def handle_cancel_broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка отмены рассылки"""
         query = update.callback_query
-        user = update.effective_user
         
         # Очищаем состояние
-        self.db.clear_user_state(user.id)
+        context.uow.clear_state()
         
         await query.edit_message_text("❌ Рассылка отменена")
         
         # Возвращаемся в админ-меню
-        await asyncio.sleep(1)
-        await self.admin_panel(update, context)
+        self.return_to_admin_panel(update, context, delay=1)
+    
+    async def post_init(self, application: Application):
+        """Запуск фоновых задач после инициализации приложения"""
+        self.background_tasks.append(asyncio.create_task(self.db.run_activity_flusher()))
+        self.background_tasks.append(asyncio.create_task(self.outbox.run(application.bot)))
+        self.background_tasks.append(asyncio.create_task(self.run_admin_digest()))
+        await self.broadcasts.resume_all(application.bot)
+        self.background_tasks.append(asyncio.create_task(self.broadcasts.run_scheduler(application.bot)))
+    
+    async def post_shutdown(self, application: Application):
+        """Остановка фоновых задач и запись накопленных данных"""
+        await self.broadcasts.shutdown()
+        await self.followups.shutdown()
+        for task in self.background_tasks:
+            task.cancel()
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+        self.background_tasks = []
+        await self.db.flush_activity()
+    
+    def build_application(self) -> Application:
+        """Создание приложения с обработчиками"""
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            # Все запросы к API проходят через единую политику повторов
+            .rate_limiter(RetryPolicy(self.limiter, on_blocked=self.db.mark_user_blocked))
+            # Разные пользователи обрабатываются параллельно, обновления одного чата — по порядку
+            .concurrent_updates(PerChatUpdateProcessor())
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .build()
+        )
+        
+        # Добавляем обработчики
+        application.add_handler(CommandHandler("start", self.start))
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
+        application.add_handler(MessageHandler(filters.PHOTO | filters.Document.ALL, self.handle_media))
+        application.add_handler(CallbackQueryHandler(self.handle_callback))
+        
+        return application
     
     def run(self):
         """Запуск бота (синхронный)"""
@@ -968,12 +1077,7 @@ class TelegramBot:
             return
         
         # Создаем приложение
-        self.application = Application.builder().token(BOT_TOKEN).build()
-        
-        # Добавляем обработчики
-        self.application.add_handler(CommandHandler("start", self.start))
-        self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
-        self.application.add_handler(CallbackQueryHandler(self.handle_callback))
+        self.application = self.build_application()
         
         # Запускаем бота
         logger.info("Запуск бота...")
@@ -991,12 +1095,7 @@ class TelegramBot:
             return
         
         # Создаем приложение
-        self.application = Application.builder().token(BOT_TOKEN).build()
-        
-        # Добавляем обработчики
-        self.application.add_handler(CommandHandler("start", self.start))
-        self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
-        self.application.add_handler(CallbackQueryHandler(self.handle_callback))
+        self.application = self.build_application()
         
         # Запускаем бота
         logger.info("Запуск бота...")
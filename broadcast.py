@@ -0,0 +1,281 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaDocument, InputMediaPhoto
+from telegram.error import BadRequest, Forbidden, TelegramError
+
+from config import (
+    SEGMENTS, BROADCAST_CONCURRENCY,
+    BROADCAST_PROGRESS_INTERVAL, BROADCAST_BATCH_SIZE, BROADCAST_SCHEDULER_INTERVAL
+)
+from database import AsyncDatabase
+from outbox import PRIORITY_BROADCAST
+from ratelimit import RateLimiter
+from router import callback_data
+
+logger = logging.getLogger(__name__)
+
+class BroadcastEngine:
+    """Рассылка с ограниченным параллелизмом, учетом лимитов Telegram,
+    сохранением статуса доставки по каждому получателю и живым прогрессом"""
+
+    def __init__(self, db: AsyncDatabase, limiter: RateLimiter = None,
+                 concurrency: int = BROADCAST_CONCURRENCY):
+        self.db = db
+        self.limiter = limiter or RateLimiter()
+        self.concurrency = max(1, concurrency)
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self._stop_requested = set()
+
+    def start(self, bot: Bot, broadcast_id: int) -> asyncio.Task:
+        """Запуск рассылки в фоне"""
+        task = self.tasks.get(broadcast_id)
+        if task is None:
+            task = asyncio.create_task(self._run(bot, broadcast_id))
+            self.tasks[broadcast_id] = task
+            task.add_done_callback(lambda _: self.tasks.pop(broadcast_id, None))
+        return task
+
+    async def resume_all(self, bot: Bot):
+        """Продолжение рассылок, прерванных остановкой бота"""
+        for broadcast in await self.db.get_unfinished_broadcasts():
+            logger.info(f"Продолжение рассылки #{broadcast['id']}")
+            self.start(bot, broadcast['id'])
+
+    async def run_scheduler(self, bot: Bot, interval: float = BROADCAST_SCHEDULER_INTERVAL):
+        """Запуск отложенных рассылок по наступлении их времени"""
+        while True:
+            for broadcast in await self.db.activate_due_broadcasts():
+                if broadcast:
+                    logger.info(f"Запуск отложенной рассылки #{broadcast['id']}")
+                    self.start(bot, broadcast['id'])
+            await asyncio.sleep(interval)
+
+    def stop(self, broadcast_id: int) -> bool:
+        """Остановка рассылки по запросу администратора"""
+        if broadcast_id not in self.tasks:
+            return False
+        self._stop_requested.add(broadcast_id)
+        return True
+
+    async def shutdown(self):
+        """Прерывание всех рассылок (они продолжатся при следующем запуске)"""
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, bot: Bot, broadcast_id: int):
+        broadcast = await self.db.get_broadcast(broadcast_id)
+        if not broadcast:
+            logger.error(f"Рассылка #{broadcast_id} не найдена")
+            return
+
+        await self.db.update_broadcast(broadcast_id, status='running')
+        progress = {
+            'sent': broadcast['sent_count'] or 0,
+            'failed': broadcast['failed_count'] or 0,
+            'total': broadcast['total_count'] or 0,
+        }
+        results: List[tuple] = []
+        recipients: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        pace = self._pacer(broadcast, progress, lambda: broadcast_id in self._stop_requested)
+        media = await self._load_media(broadcast)
+
+        async def save_results():
+            batch = results[:]
+            del results[:]
+            await self.db.save_delivery_results(broadcast_id, batch)
+
+        async def produce():
+            after = None
+            while broadcast_id not in self._stop_requested:
+                ids = await self.db.get_pending_recipients(broadcast_id, after, BROADCAST_BATCH_SIZE)
+                for telegram_id in ids:
+                    await recipients.put(telegram_id)
+                if len(ids) < BROADCAST_BATCH_SIZE:
+                    break
+                after = ids[-1]
+            for _ in range(self.concurrency):
+                await recipients.put(None)
+
+        async def work():
+            while True:
+                telegram_id = await recipients.get()
+                if telegram_id is None:
+                    return
+                if broadcast_id in self._stop_requested:
+                    continue
+                await pace()
+                if broadcast_id in self._stop_requested:
+                    continue
+                status, error = await self._deliver(bot, telegram_id, broadcast['message'], media)
+                results.append((telegram_id, status, error))
+                progress['sent' if status == 'sent' else 'failed'] += 1
+                if len(results) >= BROADCAST_BATCH_SIZE:
+                    await save_results()
+
+        async def report():
+            while True:
+                await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+                await self._show_progress(bot, broadcast, progress)
+
+        if broadcast['admin_chat_id'] and not broadcast['progress_message_id']:
+            broadcast['progress_message_id'] = await self._send_progress(bot, broadcast, progress)
+
+        reporter = asyncio.create_task(report())
+        tasks = [asyncio.create_task(produce())] + [asyncio.create_task(work()) for _ in range(self.concurrency)]
+        failed = False
+        try:
+            await asyncio.gather(*tasks)
+        except Exception as e:
+            failed = True
+            logger.error(f"Рассылка #{broadcast_id} прервана ошибкой: {e}")
+        finally:
+            # Остальные задачи не должны продолжать отправку после ошибки или отмены
+            for task in tasks:
+                task.cancel()
+            reporter.cancel()
+            await asyncio.gather(reporter, *tasks, return_exceptions=True)
+            # Результаты сохраняются и при прерывании, чтобы продолжить с места остановки
+            await save_results()
+
+        stopped = broadcast_id in self._stop_requested
+        self._stop_requested.discard(broadcast_id)
+        status = 'failed' if failed else 'cancelled' if stopped else 'done'
+        await self.db.update_broadcast(broadcast_id, status=status)
+        await self._show_progress(bot, broadcast, progress, finished=True, stopped=stopped, failed=failed)
+        outcome = 'прервана' if failed else 'остановлена' if stopped else 'завершена'
+        logger.info(
+            f"Рассылка #{broadcast_id} {outcome}: "
+            f"отправлено {progress['sent']}, ошибок {progress['failed']}"
+        )
+
+    @staticmethod
+    def _pacer(broadcast: dict, progress: dict, stopped):
+        """Равномерное распределение отправок по окну рассылки. Оставшиеся сообщения
+        делят оставшееся время окна, поэтому после перезапуска темп пересчитывается."""
+        spread = broadcast.get('spread_seconds') or 0
+        remaining = progress['total'] - progress['sent'] - progress['failed']
+        if not spread or not broadcast.get('scheduled_at') or remaining <= 0:
+            async def no_pace():
+                return
+            return no_pace
+
+        window_start = datetime.strptime(broadcast['scheduled_at'], '%Y-%m-%d %H:%M:%S')
+        window_end = window_start.replace(tzinfo=timezone.utc).timestamp() + spread
+        step = max(0.0, window_end - time.time()) / remaining
+        start = time.monotonic()
+        slot = [0]
+
+        async def pace():
+            due = start + slot[0] * step
+            slot[0] += 1
+            # Ждем короткими интервалами, чтобы остановка срабатывала сразу
+            while not stopped() and time.monotonic() < due:
+                await asyncio.sleep(min(1.0, due - time.monotonic()))
+
+        return pace
+
+    async def _load_media(self, broadcast: dict) -> List[Dict]:
+        """Медиа рассылки с file_id из кэша: файл загружен в Telegram один раз,
+        всем получателям отправляется ссылка на него"""
+        if not broadcast.get('media'):
+            return []
+        media = json.loads(broadcast['media'])
+        cached = await self.db.get_media_file_ids([item['file_unique_id'] for item in media])
+        return [dict(item, file_id=cached.get(item['file_unique_id'], item['file_id'])) for item in media]
+
+    @staticmethod
+    async def _send(bot: Bot, chat_id: int, text: str, media: List[Dict]):
+        """Отправка текста, одного файла или альбома"""
+        caption = text or None
+        if not media:
+            return await bot.send_message(chat_id=chat_id, text=text)
+        if len(media) == 1:
+            item = media[0]
+            if item['type'] == 'photo':
+                return await bot.send_photo(chat_id=chat_id, photo=item['file_id'], caption=caption)
+            return await bot.send_document(chat_id=chat_id, document=item['file_id'], caption=caption)
+        album = [
+            (InputMediaPhoto if item['type'] == 'photo' else InputMediaDocument)(
+                media=item['file_id'], caption=caption if index == 0 else None
+            )
+            for index, item in enumerate(media)
+        ]
+        return await bot.send_media_group(chat_id=chat_id, media=album)
+
+    async def _deliver(self, bot: Bot, telegram_id: int, text: str, media: List[Dict] = None) -> tuple:
+        """Отправка одному получателю: (статус, ошибка). Повторы при RetryAfter и сетевых
+        ошибках выполняет политика повторов бота, здесь записывается только итог."""
+        await self.limiter.acquire(telegram_id, PRIORITY_BROADCAST)
+        # Каждый файл альбома Telegram считает отдельным сообщением
+        for _ in range(len(media or ()) - 1):
+            await self.limiter.acquire(None, PRIORITY_BROADCAST)
+        try:
+            await self._send(bot, telegram_id, text, media)
+            return 'sent', None
+        except Forbidden as e:
+            return 'blocked', str(e)
+        except TelegramError as e:
+            logger.error(f"Ошибка отправки сообщения пользователю {telegram_id}: {e}")
+            return 'failed', str(e)
+
+    def _progress_text(self, broadcast: dict, progress: dict, finished: bool = False,
+                       stopped: bool = False, failed: bool = False) -> str:
+        done = progress['sent'] + progress['failed']
+        if failed:
+            title = f"⚠️ Рассылка #{broadcast['id']} прервана из-за ошибки"
+        elif stopped:
+            title = f"⏹ Рассылка #{broadcast['id']} остановлена"
+        elif finished:
+            title = f"📢 Рассылка #{broadcast['id']} завершена!"
+        else:
+            title = f"📤 Рассылка #{broadcast['id']} выполняется..."
+        return (
+            f"{title}\n\n"
+            f"👥 Сегмент: {SEGMENTS.get(broadcast['segment'], broadcast['segment'])}\n"
+            f"✅ Отправлено: {progress['sent']}\n"
+            f"❌ Ошибок: {progress['failed']}\n"
+            f"📊 Обработано: {done} из {progress['total']}"
+        )
+
+    def _progress_keyboard(self, broadcast_id: int) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton("⏹ Остановить рассылку", callback_data=callback_data("bstop", broadcast_id))]
+        ])
+
+    async def _send_progress(self, bot: Bot, broadcast: dict, progress: dict) -> Optional[int]:
+        try:
+            message = await bot.send_message(
+                chat_id=broadcast['admin_chat_id'],
+                text=self._progress_text(broadcast, progress),
+                reply_markup=self._progress_keyboard(broadcast['id'])
+            )
+            await self.db.update_broadcast(broadcast['id'], progress_message_id=message.message_id)
+            return message.message_id
+        except Exception as e:
+            logger.error(f"Ошибка отправки прогресса рассылки #{broadcast['id']}: {e}")
+            return None
+
+    async def _show_progress(self, bot: Bot, broadcast: dict, progress: dict,
+                             finished: bool = False, stopped: bool = False, failed: bool = False):
+        if not broadcast['admin_chat_id'] or not broadcast['progress_message_id']:
+            return
+        try:
+            await bot.edit_message_text(
+                chat_id=broadcast['admin_chat_id'],
+                message_id=broadcast['progress_message_id'],
+                text=self._progress_text(broadcast, progress, finished, stopped, failed),
+                reply_markup=None if finished else self._progress_keyboard(broadcast['id'])
+            )
+        except BadRequest as e:
+            # Текст не изменился с прошлого обновления
+            if 'not modified' not in str(e):
+                logger.error(f"Ошибка обновления прогресса рассылки #{broadcast['id']}: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка обновления прогресса рассылки #{broadcast['id']}: {e}")
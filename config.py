@@ -17,6 +17,55 @@ if not ADMIN_USER_IDS:
 
 # Конфигурация базы данных
 DATABASE_PATH = os.getenv('DATABASE_PATH', 'database.db')
+DB_READ_POOL_SIZE = int(os.getenv('DB_READ_POOL_SIZE', '4'))  # Количество соединений для чтения
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000'))  # Ожидание блокировки файла
+DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', '16384'))  # Кэш страниц на соединение
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', str(64 * 1024 * 1024)))  # Размер memory-mapped I/O
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '128'))  # Кэш подготовленных запросов
+DB_MAX_PENDING = int(os.getenv('DB_MAX_PENDING', '256'))  # Максимум запросов в очереди к потоку базы данных
+DB_CACHE_MAX_ENTRIES = int(os.getenv('DB_CACHE_MAX_ENTRIES', '10000'))  # Размер кэша пользователей и состояний
+DB_CACHE_TTL = float(os.getenv('DB_CACHE_TTL', '300'))  # Время жизни записи в кэше, секунды
+CARD_CACHE_MAX_ENTRIES = int(os.getenv('CARD_CACHE_MAX_ENTRIES', '1000'))  # Размер кэша готовых карточек заявок
+DB_GROUP_COMMIT = os.getenv('DB_GROUP_COMMIT', 'false').lower() in ('1', 'true', 'yes')  # Групповой коммит записей
+DB_GROUP_COMMIT_MAX_OPS = int(os.getenv('DB_GROUP_COMMIT_MAX_OPS', '64'))  # Максимум операций в одном коммите
+DB_GROUP_COMMIT_DELAY_MS = float(os.getenv('DB_GROUP_COMMIT_DELAY_MS', '5'))  # Ожидание пачки, миллисекунды
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', '30'))  # Период записи активности, секунды
+
+# Конфигурация рассылок
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))  # Сообщений в секунду (лимит Telegram ~30)
+BROADCAST_BURST = int(os.getenv('BROADCAST_BURST', '25'))  # Размер корзины токенов
+BROADCAST_PER_CHAT_INTERVAL = float(os.getenv('BROADCAST_PER_CHAT_INTERVAL', '1.0'))  # Интервал между сообщениями в один чат
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '10'))  # Одновременных отправок
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '5'))  # Период обновления прогресса, секунды
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', '200'))  # Размер пачки получателей и записи результатов
+BROADCAST_SCHEDULER_INTERVAL = float(os.getenv('BROADCAST_SCHEDULER_INTERVAL', '30'))  # Период проверки отложенных рассылок, секунды
+
+# Очередь исходящих сообщений
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', '5'))  # Одновременных отправок из очереди
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '5'))  # Период проверки очереди, секунды
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5'))  # Попыток при сетевых ошибках
+
+# Повторы запросов к API Telegram
+API_RETRY_MAX_ATTEMPTS = int(os.getenv('API_RETRY_MAX_ATTEMPTS', '4'))  # Попыток на один запрос
+API_RETRY_BASE_DELAY = float(os.getenv('API_RETRY_BASE_DELAY', '0.5'))  # Базовая задержка повтора, секунды
+API_RETRY_MAX_DELAY = float(os.getenv('API_RETRY_MAX_DELAY', '30'))  # Максимальная задержка повтора, секунды
+API_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('API_CIRCUIT_FAILURE_THRESHOLD', '5'))  # Сетевых ошибок подряд до размыкания
+API_CIRCUIT_RESET_TIMEOUT = float(os.getenv('API_CIRCUIT_RESET_TIMEOUT', '30'))  # Пауза перед пробным запросом, секунды
+
+# Обработка обновлений
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '64'))  # Одновременно обрабатываемых обновлений (разных чатов)
+ADMIN_MENU_RETURN_DELAY = float(os.getenv('ADMIN_MENU_RETURN_DELAY', '2'))  # Пауза перед возвратом в админ-меню, секунды
+
+# Сводка уведомлений администраторам при большом потоке заявок
+ADMIN_DIGEST_THRESHOLD = int(os.getenv('ADMIN_DIGEST_THRESHOLD', '10'))  # Заявок за окно, после которых включается сводка (0 — выключено)
+ADMIN_DIGEST_WINDOW = float(os.getenv('ADMIN_DIGEST_WINDOW', '300'))  # Окно подсчета заявок, секунды
+ADMIN_DIGEST_INTERVAL = float(os.getenv('ADMIN_DIGEST_INTERVAL', '300'))  # Период отправки сводки, секунды
+ADMIN_DIGEST_PAGE_SIZE = int(os.getenv('ADMIN_DIGEST_PAGE_SIZE', '8'))  # Заявок на странице сводки
+
+# Просмотр заявок и списков для администраторов
+APPLICATIONS_PAGE_SIZE = int(os.getenv('APPLICATIONS_PAGE_SIZE', '10'))  # Заявок на странице списка
+LISTING_MAX_MESSAGES = int(os.getenv('LISTING_MAX_MESSAGES', '5'))  # Сообщений в списке, больше — отправка файлом
+LISTING_BATCH_SIZE = int(os.getenv('LISTING_BATCH_SIZE', '500'))  # Записей, читаемых из базы за один запрос
 
 # Сообщения
 MESSAGES = {
@@ -43,3 +92,12 @@ BUTTONS = {
     'back': 'Назад',
     'cancel': 'Отмена'
 }
+
+# Сегменты пользователей для рассылок
+SEGMENTS = {
+    'all': 'Все пользователи',
+    'no_application': 'Без заявок',
+    'abandoned_form': 'Бросили оформление заявки',
+    'has_open_application': 'С открытой заявкой',
+    'completed': 'С выполненной заявкой'
+}
@@ -1,125 +1,1024 @@
+"""Хранилище бота на SQLite.
+
+Database — синхронный API, AsyncDatabase — обертка для цикла событий.
+
+Методы записи, помеченные @write_method, — генераторы. Метод передает через yield
+операцию записи op(cursor) и получает обратно ее результат (или ее исключение),
+а через return возвращает свой результат:
+
+    @write_method
+    def add_user(self, telegram_id, ...):
+        try:
+            user = yield lambda cursor: self._write_user(cursor, telegram_id, ...)
+        except Exception as e:
+            logger.error(...)
+            return False
+        self.user_cache.set(telegram_id, user)
+        return True
+
+Один и тот же код метода выполняется двумя способами:
+- синхронный вызов db.add_user(...) проходит операции по очереди через drive_write
+  и execute_write, как обычный метод;
+- при групповом коммите AsyncDatabase выполняет код метода в потоке базы данных
+  (write_step), а готовую операцию отдает GroupCommitWriter и ждет ее в цикле событий.
+  Поток базы данных не простаивает в ожидании коммита, поэтому записи разных
+  обновлений попадают в одну транзакцию, а чтения не стоят за ними в очереди.
+Код метода между yield выполняется в потоке базы данных: в нем можно читать базу
+и кэши, но нельзя ждать цикл событий.
+"""
+import asyncio
+import functools
+import json
 import sqlite3
 import logging
-from datetime import datetime
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, asynccontextmanager
+from datetime import datetime, timezone
 from typing import List, Dict, Optional
-from config import DATABASE_PATH
+from cache import LRUCache, MISSING
+from config import (
+    DATABASE_PATH, DB_READ_POOL_SIZE, DB_BUSY_TIMEOUT_MS, DB_CACHE_SIZE_KB,
+    DB_MMAP_SIZE, DB_STATEMENT_CACHE_SIZE, DB_MAX_PENDING, DB_CACHE_MAX_ENTRIES, DB_CACHE_TTL,
+    DB_GROUP_COMMIT, DB_GROUP_COMMIT_MAX_OPS, DB_GROUP_COMMIT_DELAY_MS, ACTIVITY_FLUSH_INTERVAL
+)
 
 logger = logging.getLogger(__name__)
 
+# Сегменты пользователей. Материализованные хранятся в user_segments и поддерживаются
+# триггерами; 'abandoned_form' зависит от времени и читается по частичному индексу user_states.
+MATERIALIZED_SEGMENTS = ('no_application', 'has_open_application', 'completed')
+SEGMENTS = ('all',) + MATERIALIZED_SEGMENTS + ('abandoned_form',)
+# Коды состояний пользователя в user_states.state; в памяти состояние хранится по имени
+STATE_CODES = {
+    'application_fio': 1,
+    'application_phone': 2,
+    'application_info': 3,
+    'delete_application': 10,
+    'reply_application': 11,
+    'broadcast_message': 20,
+    'broadcast_schedule': 21,
+}
+STATE_NAMES = {code: name for name, code in STATE_CODES.items()}
+# Поля состояния в отдельных столбцах user_states
+STATE_FIELDS = ('ref_id', 'fio', 'phone', 'started_at', 'draft')
+FORM_STATES = ('application_fio', 'application_phone', 'application_info')
+# Литерал нужен, чтобы планировщик мог использовать частичный индекс
+FORM_STATES_SQL = "(1, 2, 3)"
+ABANDONED_FORM_AFTER = 24 * 60 * 60  # Секунды без движения по анкете
+
+def _segment_refresh_sql(user_id: str) -> str:
+    """SQL пересчета материализованных сегментов для пользователя с users.id = user_id"""
+    return f'''
+        DELETE FROM user_segments
+        WHERE telegram_id = (SELECT telegram_id FROM users WHERE id = {user_id})
+          AND segment IN ('no_application', 'has_open_application', 'completed');
+        INSERT OR IGNORE INTO user_segments (segment, telegram_id)
+        SELECT 'no_application', u.telegram_id FROM users u
+        WHERE u.id = {user_id}
+          AND NOT EXISTS (SELECT 1 FROM applications a WHERE a.user_id = u.id);
+        INSERT OR IGNORE INTO user_segments (segment, telegram_id)
+        SELECT 'has_open_application', u.telegram_id FROM users u
+        WHERE u.id = {user_id}
+          AND EXISTS (SELECT 1 FROM applications a WHERE a.user_id = u.id AND a.status IS NOT 'Выполнена');
+        INSERT OR IGNORE INTO user_segments (segment, telegram_id)
+        SELECT 'completed', u.telegram_id FROM users u
+        WHERE u.id = {user_id}
+          AND EXISTS (SELECT 1 FROM applications a WHERE a.user_id = u.id AND a.status = 'Выполнена');
+    '''
+
+# Миграции схемы: (версия, описание, шаги). Шаг — SQL-выражение или функция от курсора.
+# Применяются по возрастанию версии при запуске; новые миграции добавляются только в конец.
+MIGRATIONS = [
+    (1, 'Базовые таблицы', [
+        # Таблица пользователей
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            phone TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Таблица заявок
+        '''
+        CREATE TABLE IF NOT EXISTS applications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            additional_info TEXT,
+            status TEXT DEFAULT 'new',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+        # Таблица состояний пользователей (для FSM)
+        '''
+        CREATE TABLE IF NOT EXISTS user_states (
+            user_id INTEGER PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (telegram_id)
+        )
+        ''',
+        # Таблица рассылок
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message TEXT NOT NULL,
+            sent_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (2, 'Индексы для частых запросов', [
+        'CREATE INDEX IF NOT EXISTS idx_applications_user_id ON applications (user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_applications_created_at ON applications (created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_applications_status ON applications (status)',
+        'CREATE INDEX IF NOT EXISTS idx_user_states_state_updated_at ON user_states (state, updated_at)',
+    ]),
+    (3, 'Счетчики статистики, поддерживаемые триггерами', [
+        '''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        ''',
+        # Начальные значения по текущим данным
+        "INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'users_total', COUNT(*) FROM users",
+        "INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'applications_total', COUNT(*) FROM applications",
+        '''
+        INSERT OR REPLACE INTO stats_counters (name, value)
+        SELECT 'users_with_applications', COUNT(*) FROM users u
+        WHERE EXISTS (SELECT 1 FROM applications a WHERE a.user_id = u.id)
+        ''',
+        '''
+        INSERT OR REPLACE INTO stats_counters (name, value)
+        SELECT 'status:' || COALESCE(status, ''), COUNT(*) FROM applications GROUP BY status
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_users_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO stats_counters (name, value) VALUES ('users_total', 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_users_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'users_total';
+            UPDATE stats_counters SET value = value - 1
+            WHERE name = 'users_with_applications'
+              AND EXISTS (SELECT 1 FROM applications WHERE user_id = OLD.id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_applications_insert AFTER INSERT ON applications
+        BEGIN
+            INSERT INTO stats_counters (name, value) VALUES ('applications_total', 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + 1;
+            INSERT INTO stats_counters (name, value) VALUES ('status:' || COALESCE(NEW.status, ''), 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + 1;
+            INSERT INTO stats_counters (name, value)
+            SELECT 'users_with_applications', 1
+            WHERE EXISTS (SELECT 1 FROM users WHERE id = NEW.user_id)
+              AND NOT EXISTS (SELECT 1 FROM applications WHERE user_id = NEW.user_id AND id != NEW.id)
+            ON CONFLICT(name) DO UPDATE SET value = value + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_applications_delete AFTER DELETE ON applications
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'applications_total';
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'status:' || COALESCE(OLD.status, '');
+            UPDATE stats_counters SET value = value - 1
+            WHERE name = 'users_with_applications'
+              AND EXISTS (SELECT 1 FROM users WHERE id = OLD.user_id)
+              AND NOT EXISTS (SELECT 1 FROM applications WHERE user_id = OLD.user_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_applications_status AFTER UPDATE OF status ON applications
+        WHEN OLD.status IS NOT NEW.status
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'status:' || COALESCE(OLD.status, '');
+            INSERT INTO stats_counters (name, value) VALUES ('status:' || COALESCE(NEW.status, ''), 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + 1;
+        END
+        ''',
+    ]),
+    (4, 'Дневные агрегаты аналитики и воронки заявок', [
+        '''
+        CREATE TABLE IF NOT EXISTS analytics_daily (
+            day TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, metric)
+        ) WITHOUT ROWID
+        ''',
+        # Начальные значения: шаги формы по прошлым данным восстановить нельзя
+        '''
+        INSERT OR REPLACE INTO analytics_daily (day, metric, value)
+        SELECT date(created_at), 'users_new', COUNT(*) FROM users GROUP BY date(created_at)
+        ''',
+        '''
+        INSERT OR REPLACE INTO analytics_daily (day, metric, value)
+        SELECT date(created_at), 'applications_created', COUNT(*) FROM applications GROUP BY date(created_at)
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_analytics_users_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO analytics_daily (day, metric, value) VALUES (date('now'), 'users_new', 1)
+            ON CONFLICT(day, metric) DO UPDATE SET value = value + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_analytics_states_insert AFTER INSERT ON user_states
+        WHEN NEW.state IN ('application_fio', 'application_phone', 'application_info')
+        BEGIN
+            INSERT INTO analytics_daily (day, metric, value)
+            VALUES (date('now'), CASE NEW.state
+                WHEN 'application_fio' THEN 'form_started'
+                WHEN 'application_phone' THEN 'form_phone'
+                ELSE 'form_info' END, 1)
+            ON CONFLICT(day, metric) DO UPDATE SET value = value + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_analytics_states_update AFTER UPDATE OF state ON user_states
+        WHEN OLD.state IS NOT NEW.state
+         AND NEW.state IN ('application_fio', 'application_phone', 'application_info')
+        BEGIN
+            INSERT INTO analytics_daily (day, metric, value)
+            VALUES (date('now'), CASE NEW.state
+                WHEN 'application_fio' THEN 'form_started'
+                WHEN 'application_phone' THEN 'form_phone'
+                ELSE 'form_info' END, 1)
+            ON CONFLICT(day, metric) DO UPDATE SET value = value + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_analytics_applications_insert AFTER INSERT ON applications
+        BEGIN
+            INSERT INTO analytics_daily (day, metric, value) VALUES (date('now'), 'applications_created', 1)
+            ON CONFLICT(day, metric) DO UPDATE SET value = value + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_analytics_applications_completed AFTER UPDATE OF status ON applications
+        WHEN NEW.status = 'Выполнена' AND OLD.status IS NOT NEW.status
+        BEGIN
+            INSERT INTO analytics_daily (day, metric, value) VALUES (date('now'), 'applications_completed', 1)
+            ON CONFLICT(day, metric) DO UPDATE SET value = value + 1;
+        END
+        ''',
+    ]),
+    (5, 'Сегменты пользователей', [
+        '''
+        CREATE TABLE IF NOT EXISTS user_segments (
+            segment TEXT NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            PRIMARY KEY (segment, telegram_id)
+        ) WITHOUT ROWID
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_user_segments_telegram_id ON user_segments (telegram_id)',
+        # Частичный индекс для сегмента брошенных форм: один проход в порядке (updated_at, user_id)
+        '''
+        CREATE INDEX IF NOT EXISTS idx_user_states_form_updated_at ON user_states (updated_at, user_id)
+        WHERE state IN ('application_fio', 'application_phone', 'application_info')
+        ''',
+        # Начальное заполнение
+        '''
+        INSERT OR IGNORE INTO user_segments (segment, telegram_id)
+        SELECT 'no_application', u.telegram_id FROM users u
+        WHERE NOT EXISTS (SELECT 1 FROM applications a WHERE a.user_id = u.id)
+        ''',
+        '''
+        INSERT OR IGNORE INTO user_segments (segment, telegram_id)
+        SELECT DISTINCT 'has_open_application', u.telegram_id FROM users u
+        JOIN applications a ON a.user_id = u.id
+        WHERE a.status IS NOT 'Выполнена'
+        ''',
+        '''
+        INSERT OR IGNORE INTO user_segments (segment, telegram_id)
+        SELECT DISTINCT 'completed', u.telegram_id FROM users u
+        JOIN applications a ON a.user_id = u.id
+        WHERE a.status = 'Выполнена'
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_segments_users_insert AFTER INSERT ON users
+        BEGIN {_segment_refresh_sql('NEW.id')} END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_segments_users_delete AFTER DELETE ON users
+        BEGIN
+            DELETE FROM user_segments WHERE telegram_id = OLD.telegram_id;
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_segments_applications_insert AFTER INSERT ON applications
+        BEGIN {_segment_refresh_sql('NEW.user_id')} END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_segments_applications_delete AFTER DELETE ON applications
+        BEGIN {_segment_refresh_sql('OLD.user_id')} END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_segments_applications_status AFTER UPDATE OF status ON applications
+        WHEN OLD.status IS NOT NEW.status
+        BEGIN {_segment_refresh_sql('NEW.user_id')} END
+        ''',
+    ]),
+    (6, 'Состояние рассылок и доставка по получателям', [
+        "ALTER TABLE broadcasts ADD COLUMN segment TEXT DEFAULT 'all'",
+        "ALTER TABLE broadcasts ADD COLUMN status TEXT DEFAULT 'pending'",
+        'ALTER TABLE broadcasts ADD COLUMN total_count INTEGER DEFAULT 0',
+        'ALTER TABLE broadcasts ADD COLUMN failed_count INTEGER DEFAULT 0',
+        'ALTER TABLE broadcasts ADD COLUMN admin_chat_id INTEGER',
+        'ALTER TABLE broadcasts ADD COLUMN progress_message_id INTEGER',
+        'ALTER TABLE broadcasts ADD COLUMN finished_at TIMESTAMP',
+        # Рассылки, созданные до миграции, уже завершены
+        "UPDATE broadcasts SET status = 'done'",
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id INTEGER NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            error TEXT,
+            sent_at TIMESTAMP,
+            PRIMARY KEY (broadcast_id, telegram_id)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_pending
+        ON broadcast_recipients (broadcast_id, telegram_id) WHERE status = 'pending'
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status)",
+    ]),
+    (7, 'Очередь исходящих сообщений', [
+        '''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            priority INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            method TEXT NOT NULL DEFAULT 'send_message',
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Выборка диспетчера: сначала более приоритетные, внутри приоритета по порядку
+        "CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (priority, id) WHERE status = 'pending'",
+    ]),
+    (8, 'Отложенные рассылки с равномерной доставкой', [
+        'ALTER TABLE broadcasts ADD COLUMN scheduled_at TIMESTAMP',
+        'ALTER TABLE broadcasts ADD COLUMN spread_seconds INTEGER DEFAULT 0',
+        "CREATE INDEX IF NOT EXISTS idx_broadcasts_scheduled ON broadcasts (scheduled_at) WHERE status = 'scheduled'",
+    ]),
+    (9, 'Медиа в рассылках и кэш file_id', [
+        'ALTER TABLE broadcasts ADD COLUMN media TEXT',
+        # file_unique_id одинаков для одного и того же содержимого файла
+        '''
+        CREATE TABLE IF NOT EXISTS media_files (
+            file_unique_id TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            media_type TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (10, 'Сводки уведомлений администраторам', [
+        # Заявки, ожидающие попадания в следующую сводку
+        'CREATE TABLE IF NOT EXISTS admin_digest_queue (application_id INTEGER PRIMARY KEY)',
+        '''
+        CREATE TABLE IF NOT EXISTS admin_digests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            application_ids TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (11, 'Пользователи, заблокировавшие бота', [
+        'ALTER TABLE users ADD COLUMN blocked_at TIMESTAMP',
+        'CREATE INDEX IF NOT EXISTS idx_users_blocked ON users (telegram_id) WHERE blocked_at IS NOT NULL',
+    ]),
+    (12, 'Постраничный просмотр заявок', [
+        # Ключ курсора (created_at, id): страница читается по индексу без OFFSET;
+        # индекс только по created_at становится лишним
+        'CREATE INDEX IF NOT EXISTS idx_applications_created_at_id ON applications (created_at, id)',
+        'DROP INDEX IF EXISTS idx_applications_created_at',
+    ]),
+    (13, 'Типизированные состояния пользователей', [
+        # Поля анкеты в отдельных столбцах вместо JSON, время — целые секунды Unix.
+        # В draft остается только черновик рассылки администратора (текст и медиа)
+        '''
+        CREATE TABLE IF NOT EXISTS user_states_typed (
+            user_id INTEGER PRIMARY KEY,
+            state INTEGER NOT NULL,
+            ref_id INTEGER,
+            fio TEXT,
+            phone TEXT,
+            started_at INTEGER,
+            updated_at INTEGER NOT NULL,
+            draft TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (telegram_id)
+        )
+        ''',
+        # Перенос строк старого формата; reply_application_<id> разбирается в код и ref_id,
+        # неизвестные состояния не переносятся
+        '''
+        INSERT OR IGNORE INTO user_states_typed
+            (user_id, state, ref_id, fio, phone, started_at, updated_at, draft)
+        SELECT user_id, code,
+               CASE WHEN code = 11 THEN CAST(substr(state, 19) AS INTEGER) END,
+               CASE WHEN code IN (2, 3) AND json_valid(data) THEN json_extract(data, '$.fio') END,
+               CASE WHEN code = 3 AND json_valid(data) THEN json_extract(data, '$.phone') END,
+               CASE WHEN code IN (1, 2, 3) AND json_valid(data) THEN json_extract(data, '$.started_at') END,
+               COALESCE(CAST(strftime('%s', updated_at) AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER)),
+               CASE WHEN code IN (20, 21) THEN data END
+        FROM (
+            SELECT *, CASE
+                WHEN state = 'application_fio' THEN 1
+                WHEN state = 'application_phone' THEN 2
+                WHEN state = 'application_info' THEN 3
+                WHEN state = 'delete_application' THEN 10
+                WHEN substr(state, 1, 18) = 'reply_application_' THEN 11
+                WHEN state = 'broadcast_message' THEN 20
+                WHEN state = 'broadcast_schedule' THEN 21
+            END AS code
+            FROM user_states
+        )
+        WHERE code IS NOT NULL
+        ''',
+        # Вместе со старой таблицей удаляются ее индексы и триггеры аналитики
+        'DROP TABLE user_states',
+        'ALTER TABLE user_states_typed RENAME TO user_states',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_user_states_form_updated_at ON user_states (updated_at, user_id)
+        WHERE state IN (1, 2, 3)
+        ''',
+        # Индекс из миграции 2 для выборки напоминаний по коду состояния и времени
+        'CREATE INDEX IF NOT EXISTS idx_user_states_state_updated_at ON user_states (state, updated_at)',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_analytics_states_insert AFTER INSERT ON user_states
+        WHEN NEW.state IN (1, 2, 3)
+        BEGIN
+            INSERT INTO analytics_daily (day, metric, value)
+            VALUES (date('now'), CASE NEW.state
+                WHEN 1 THEN 'form_started'
+                WHEN 2 THEN 'form_phone'
+                ELSE 'form_info' END, 1)
+            ON CONFLICT(day, metric) DO UPDATE SET value = value + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_analytics_states_update AFTER UPDATE OF state ON user_states
+        WHEN OLD.state IS NOT NEW.state AND NEW.state IN (1, 2, 3)
+        BEGIN
+            INSERT INTO analytics_daily (day, metric, value)
+            VALUES (date('now'), CASE NEW.state
+                WHEN 1 THEN 'form_started'
+                WHEN 2 THEN 'form_phone'
+                ELSE 'form_info' END, 1)
+            ON CONFLICT(day, metric) DO UPDATE SET value = value + 1;
+        END
+        ''',
+    ]),
+]
+
+# Границы корзин гистограммы времени заполнения формы, секунды
+COMPLETION_BUCKETS = (60, 180, 300, 600, 1800, 3600, 3 * 3600, 24 * 3600)
+
+def write_method(method):
+    """Метод записи в виде генератора: операция записи op(cursor) передается через yield,
+    результат операции возвращается в метод. Синхронный вызов выполняет операции через
+    execute_write; AsyncDatabase выполняет код метода в потоке базы данных, а записи
+    ожидает в цикле событий, не занимая этот поток"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return drive_write(method(self, *args, **kwargs), self.execute_write)
+    wrapper.write_steps = method
+    return wrapper
+
+def write_step(steps, result=None, error: Exception = None):
+    """Выполнение метода записи до следующей операции: (True, результат метода) или (False, операция)"""
+    try:
+        op = steps.throw(error) if error is not None else steps.send(result)
+    except StopIteration as stop:
+        return True, stop.value
+    return False, op
+
+def drive_write(steps, execute_write):
+    """Синхронное выполнение метода записи"""
+    done, value = write_step(steps)
+    while not done:
+        try:
+            result = execute_write(value)
+        except Exception as e:
+            done, value = write_step(steps, error=e)
+        else:
+            done, value = write_step(steps, result)
+    return value
+
+class ConnectionManager:
+    """Долгоживущие соединения с SQLite: одно для записи и пул для чтения"""
+
+    _instances: Dict[str, 'ConnectionManager'] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, db_path: str, read_pool_size: int = DB_READ_POOL_SIZE):
+        self.db_path = db_path
+        self.read_pool_size = max(1, read_pool_size)
+        self._writer = None
+        self._write_lock = threading.RLock()
+        self._write_depth = 0
+        self._readers = queue.LifoQueue()
+        self._readers_created = 0
+        self._readers_lock = threading.Lock()
+        self._group_writer = None
+
+    @classmethod
+    def get(cls, db_path: str) -> 'ConnectionManager':
+        """Получение общего менеджера для файла базы данных"""
+        with cls._instances_lock:
+            manager = cls._instances.get(db_path)
+            if manager is None:
+                manager = cls(db_path)
+                cls._instances[db_path] = manager
+            return manager
+
+    def _connect(self) -> sqlite3.Connection:
+        """Открытие соединения с настройками производительности"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE_SIZE
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT_MS)}')
+        conn.execute(f'PRAGMA cache_size = {-int(DB_CACHE_SIZE_KB)}')
+        conn.execute(f'PRAGMA mmap_size = {int(DB_MMAP_SIZE)}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        return conn
+
+    @contextmanager
+    def write(self):
+        """Транзакция на соединении записи (вложенные вызовы входят во внешнюю транзакцию)"""
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            conn = self._writer
+            if self._write_depth > 0:
+                self._write_depth += 1
+                try:
+                    yield conn
+                finally:
+                    self._write_depth -= 1
+                return
+
+            conn.execute('BEGIN IMMEDIATE')
+            self._write_depth = 1
+            try:
+                yield conn
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            finally:
+                self._write_depth = 0
+
+    @contextmanager
+    def read(self):
+        """Соединение для чтения из пула"""
+        conn = self._acquire_reader()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    def _acquire_reader(self) -> sqlite3.Connection:
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._readers_lock:
+            if self._readers_created < self.read_pool_size:
+                self._readers_created += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._readers_lock:
+                    self._readers_created -= 1
+                raise
+
+        return self._readers.get(timeout=DB_BUSY_TIMEOUT_MS / 1000)
+
+    def group_writer(self) -> 'GroupCommitWriter':
+        """Общий поток группового коммита для файла базы данных"""
+        with self._readers_lock:
+            if self._group_writer is None:
+                self._group_writer = GroupCommitWriter(self)
+                self._group_writer.start()
+            return self._group_writer
+
+    def close(self):
+        """Закрытие всех соединений"""
+        with self._readers_lock:
+            writer, self._group_writer = self._group_writer, None
+        if writer is not None:
+            writer.stop()
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._readers_lock:
+            while True:
+                try:
+                    self._readers.get_nowait().close()
+                except queue.Empty:
+                    break
+            self._readers_created = 0
+
+class GroupCommitWriter:
+    """Поток записи с групповым коммитом: собирает операции от всех обработчиков
+    и фиксирует их пачками (до max_ops операций или через max_delay_ms)"""
+
+    def __init__(self, connections: ConnectionManager, max_ops: int = DB_GROUP_COMMIT_MAX_OPS,
+                 max_delay_ms: float = DB_GROUP_COMMIT_DELAY_MS):
+        self.connections = connections
+        self.max_ops = max(1, max_ops)
+        self.max_delay = max(0.0, max_delay_ms) / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        """Запуск потока записи"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='database-writer', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Остановка потока после записи уже поставленных операций"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, op) -> Future:
+        """Постановка операции op(cursor) в очередь; результат доступен после коммита пачки"""
+        future = Future()
+        self._queue.put((op, future))
+        return future
+
+    def _run(self):
+        running = True
+        while running:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_ops:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        outcomes = []
+        try:
+            with self.connections.write() as conn:
+                cursor = conn.cursor()
+                for op, future in batch:
+                    # Каждая операция в своей точке сохранения: ошибка одной не отменяет остальные
+                    cursor.execute('SAVEPOINT group_op')
+                    try:
+                        outcomes.append((future, op(cursor), None))
+                        cursor.execute('RELEASE group_op')
+                    except Exception as e:
+                        cursor.execute('ROLLBACK TO group_op')
+                        cursor.execute('RELEASE group_op')
+                        outcomes.append((future, None, e))
+        except Exception as e:
+            logger.error(f"Ошибка группового коммита ({len(batch)} операций): {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+class ActivityTracker:
+    """Время последней активности пользователей: обновляется в памяти
+    и периодически записывается в базу одной пачкой"""
+
+    def __init__(self, db: 'Database'):
+        self.db = db
+        self._pending: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def touch(self, telegram_id: int):
+        """Отметка активности пользователя"""
+        with self._lock:
+            self._pending[telegram_id] = Database._now()
+
+    def flush(self) -> int:
+        """Запись накопленной активности; возвращает количество пользователей"""
+        return drive_write(self.flush_steps(), self.db.execute_write)
+
+    def flush_steps(self):
+        """flush() в виде метода записи (см. write_method)"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        rows = [(last_activity, last_activity, telegram_id) for telegram_id, last_activity in pending.items()]
+        try:
+            yield (
+                # Написавший боту пользователь его больше не блокирует, если блокировка
+                # не отмечена позже его последней активности
+                lambda cursor: cursor.executemany('''
+                    UPDATE users SET last_activity = ?,
+                        blocked_at = CASE WHEN blocked_at > ? THEN blocked_at ELSE NULL END
+                    WHERE telegram_id = ?
+                ''', rows)
+            )
+            return len(rows)
+        except Exception as e:
+            logger.error(f"Ошибка записи активности пользователей: {e}")
+            # Возвращаем записи, если за это время не появилось более свежих
+            with self._lock:
+                for telegram_id, last_activity in pending.items():
+                    self._pending.setdefault(telegram_id, last_activity)
+            return 0
+
 class Database:
     def __init__(self):
         self.db_path = DATABASE_PATH
+        self.connections = ConnectionManager.get(self.db_path)
+        self.user_cache = LRUCache(DB_CACHE_MAX_ENTRIES, DB_CACHE_TTL)
+        self.state_cache = LRUCache(DB_CACHE_MAX_ENTRIES, DB_CACHE_TTL)
         self.init_database()
+        self.writer = self.connections.group_writer() if DB_GROUP_COMMIT else None
+        self.activity = ActivityTracker(self)
+        # Подписчики на появление новых сообщений в очереди (диспетчер отправки)
+        self.outbox_listeners = []
+
+    def close(self):
+        """Закрытие соединений с базой данных"""
+        self.activity.flush()
+        self.connections.close()
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """Статистика попаданий в кэш пользователей и состояний"""
+        return {'users': self.user_cache.stats(), 'states': self.state_cache.stats()}
+
+    @staticmethod
+    def _now() -> str:
+        """Текущее время в формате CURRENT_TIMESTAMP"""
+        return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+    # Операции записи на открытом курсоре (используются и методами, и UnitOfWork)
+
+    @staticmethod
+    def _write_user(cursor, telegram_id: int, username: str, first_name: str, last_name: str) -> Optional[Dict]:
+        # UPSERT сохраняет users.id (и ссылки из applications) при повторном /start
+        cursor.execute('''
+            INSERT INTO users (telegram_id, username, first_name, last_name, last_activity)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(telegram_id) DO UPDATE SET
+                username = excluded.username,
+                first_name = excluded.first_name,
+                last_name = excluded.last_name,
+                last_activity = excluded.last_activity,
+                blocked_at = NULL
+        ''', (telegram_id, username, first_name, last_name))
+        cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
+        user = cursor.fetchone()
+        return dict(user) if user else None
+
+    @staticmethod
+    def _write_application(cursor, user_id: int, name: str, phone: str, additional_info: str, status: str) -> Dict:
+        params = (user_id, name, phone, additional_info, status)
+        if sqlite3.sqlite_version_info >= (3, 35, 0):
+            cursor.execute('''
+                INSERT INTO applications (user_id, name, phone, additional_info, status)
+                VALUES (?, ?, ?, ?, ?)
+                RETURNING *
+            ''', params)
+            return dict(cursor.fetchone())
+        # Старые версии SQLite без RETURNING: читаем строку по lastrowid в той же транзакции
+        cursor.execute('''
+            INSERT INTO applications (user_id, name, phone, additional_info, status)
+            VALUES (?, ?, ?, ?, ?)
+        ''', params)
+        cursor.execute('SELECT * FROM applications WHERE id = ?', (cursor.lastrowid,))
+        return dict(cursor.fetchone())
+
+    @staticmethod
+    def _state_record(user_id: int, state: str, fields: Dict) -> Dict:
+        """Состояние в памяти: имя, поля из STATE_FIELDS и время изменения (секунды Unix)"""
+        if state not in STATE_CODES:
+            raise ValueError(f"Неизвестное состояние: {state}")
+        unknown = set(fields) - set(STATE_FIELDS)
+        if unknown:
+            raise ValueError(f"Неизвестные поля состояния: {', '.join(sorted(unknown))}")
+        record = {'user_id': user_id, 'state': state, 'updated_at': int(time.time())}
+        record.update({field: fields.get(field) for field in STATE_FIELDS})
+        return record
+
+    @staticmethod
+    def _state_from_row(row) -> Optional[Dict]:
+        """Состояние из строки user_states (код заменяется именем)"""
+        if row is None:
+            return None
+        state = dict(row)
+        state['state'] = STATE_NAMES.get(state['state'])
+        return state if state['state'] else None
+
+    @staticmethod
+    def _write_state(cursor, state: Dict):
+        # UPSERT вместо REPLACE, чтобы триггеры аналитики видели смену состояния
+        cursor.execute('''
+            INSERT INTO user_states (user_id, state, ref_id, fio, phone, started_at, updated_at, draft)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                state = excluded.state,
+                ref_id = excluded.ref_id,
+                fio = excluded.fio,
+                phone = excluded.phone,
+                started_at = excluded.started_at,
+                updated_at = excluded.updated_at,
+                draft = excluded.draft
+        ''', (state['user_id'], STATE_CODES[state['state']], state['ref_id'], state['fio'],
+              state['phone'], state['started_at'], state['updated_at'], state['draft']))
+
+    @staticmethod
+    def _touch_state(cursor, user_id: int, updated_at: int):
+        cursor.execute('UPDATE user_states SET updated_at = ? WHERE user_id = ?', (updated_at, user_id))
+
+    @staticmethod
+    def _write_metric(cursor, metric: str, amount: int = 1):
+        cursor.execute('''
+            INSERT INTO analytics_daily (day, metric, value) VALUES (date('now'), ?, ?)
+            ON CONFLICT(day, metric) DO UPDATE SET value = value + excluded.value
+        ''', (metric, amount))
+
+    @staticmethod
+    def completion_metric(seconds: float) -> str:
+        """Название корзины гистограммы для времени заполнения формы"""
+        for bound in COMPLETION_BUCKETS:
+            if seconds <= bound:
+                return f'completion_le_{bound}'
+        return f'completion_gt_{COMPLETION_BUCKETS[-1]}'
+
+    @staticmethod
+    def _delete_state(cursor, user_id: int):
+        cursor.execute('DELETE FROM user_states WHERE user_id = ?', (user_id,))
+
+    @staticmethod
+    def _write_application_status(cursor, application_id: int, status: str) -> bool:
+        cursor.execute('UPDATE applications SET status = ? WHERE id = ?', (status, application_id))
+        return cursor.rowcount > 0
+
+    @staticmethod
+    def _delete_application(cursor, application_id: int) -> bool:
+        cursor.execute('DELETE FROM applications WHERE id = ?', (application_id,))
+        return cursor.rowcount > 0
+
+    @staticmethod
+    def _write_outbox(cursor, chat_id: int, priority: int, payload: Dict, method: str = 'send_message') -> int:
+        cursor.execute(
+            'INSERT INTO outbox (priority, chat_id, method, payload) VALUES (?, ?, ?, ?)',
+            (priority, chat_id, method, json.dumps(payload, ensure_ascii=False))
+        )
+        return cursor.lastrowid
+
+    def execute_write(self, op):
+        """Выполнение операции op(cursor) в транзакции записи (через групповой коммит, если он включен)"""
+        if self.writer is not None:
+            return self.writer.submit(op).result()
+        with self.connections.write() as conn:
+            return op(conn.cursor())
+
+    def unit_of_work(self, telegram_id: int) -> 'UnitOfWork':
+        """Создание единицы работы для обновления от пользователя"""
+        return UnitOfWork(self, telegram_id).load()
     
     def init_database(self):
-        """Инициализация базы данных и создание таблиц"""
+        """Инициализация базы данных и применение миграций"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.connections.write() as conn:
                 cursor = conn.cursor()
                 
-                # Таблица пользователей
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS users (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        telegram_id INTEGER UNIQUE NOT NULL,
-                        username TEXT,
-                        first_name TEXT,
-                        last_name TEXT,
-                        phone TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-                
-                # Таблица заявок
+                # Таблица версий схемы
                 cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS applications (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER NOT NULL,
-                        name TEXT NOT NULL,
-                        phone TEXT NOT NULL,
-                        additional_info TEXT,
-                        status TEXT DEFAULT 'new',
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users (id)
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY,
+                        description TEXT,
+                        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     )
                 ''')
                 
-                # Таблица состояний пользователей (для FSM)
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS user_states (
-                        user_id INTEGER PRIMARY KEY,
-                        state TEXT,
-                        data TEXT,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users (telegram_id)
-                    )
-                ''')
+                cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+                current_version = cursor.fetchone()[0]
                 
-                # Таблица рассылок
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS broadcasts (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        message TEXT NOT NULL,
-                        sent_count INTEGER DEFAULT 0,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                # Применяем новые миграции по порядку в одной транзакции
+                for version, description, steps in MIGRATIONS:
+                    if version <= current_version:
+                        continue
+                    for step in steps:
+                        if callable(step):
+                            step(cursor)
+                        else:
+                            cursor.execute(step)
+                    cursor.execute(
+                        'INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                        (version, description)
                     )
-                ''')
+                    logger.info(f"Применена миграция {version}: {description}")
                 
-                conn.commit()
                 logger.info("База данных инициализирована успешно")
                 
         except Exception as e:
             logger.error(f"Ошибка инициализации базы данных: {e}")
     
+    @write_method
     def add_user(self, telegram_id: int, username: str = None, first_name: str = None, last_name: str = None):
         """Добавление нового пользователя"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT OR REPLACE INTO users (telegram_id, username, first_name, last_name, last_activity)
-                    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-                ''', (telegram_id, username, first_name, last_name))
-                conn.commit()
-                return True
+            user = (yield
+                lambda cursor: self._write_user(cursor, telegram_id, username, first_name, last_name)
+            )
+            self.user_cache.set(telegram_id, user)
+            return True
         except Exception as e:
+            self.user_cache.delete(telegram_id)
             logger.error(f"Ошибка добавления пользователя: {e}")
             return False
     
     def get_user(self, telegram_id: int) -> Optional[Dict]:
         """Получение информации о пользователе"""
+        cached = self.user_cache.get(telegram_id)
+        if cached is not MISSING:
+            return dict(cached) if cached else None
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.connections.read() as conn:
                 cursor = conn.cursor()
                 cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
                 user = cursor.fetchone()
-                return dict(user) if user else None
+                user = dict(user) if user else None
+            self.user_cache.set(telegram_id, user)
+            return dict(user) if user else None
         except Exception as e:
             logger.error(f"Ошибка получения пользователя: {e}")
             return None
     
-    def add_application(self, user_id: int, name: str, phone: str, additional_info: str = None, status: str = 'Новая') -> bool:
-        """Добавление новой заявки"""
+    @write_method
+    def add_application(self, user_id: int, name: str, phone: str, additional_info: str = None, status: str = 'Новая') -> Optional[Dict]:
+        """Добавление новой заявки; возвращает созданную строку (id, created_at, status, ...)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT INTO applications (user_id, name, phone, additional_info, status)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (user_id, name, phone, additional_info, status))
-                conn.commit()
-                return True
+            return (yield
+                lambda cursor: self._write_application(cursor, user_id, name, phone, additional_info, status)
+            )
         except Exception as e:
             logger.error(f"Ошибка добавления заявки: {e}")
-            return False
+            return None
     
     def get_applications(self, limit: int = 50) -> List[Dict]:
         """Получение списка заявок"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.connections.read() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT a.*, u.telegram_id, u.username, u.first_name, u.last_name
@@ -134,22 +1033,156 @@ class Database:
             logger.error(f"Ошибка получения заявок: {e}")
             return []
     
+    def get_applications_page(self, cursor: tuple = None, older: bool = True, limit: int = 10) -> Dict:
+        """Страница заявок от новых к старым по курсору (created_at, id) соседней страницы.
+        older=True — заявки старше курсора, иначе новее. Читается limit + 1 строка:
+        лишняя строка показывает, есть ли еще страница в том же направлении."""
+        page = {'applications': [], 'has_older': False, 'has_newer': False}
+        try:
+            with self.connections.read() as conn:
+                sql = 'SELECT id, name, phone, status, created_at FROM applications'
+                params = []
+                if cursor is not None:
+                    sql += ' WHERE (created_at, id) < (?, ?)' if older else ' WHERE (created_at, id) > (?, ?)'
+                    params.extend(cursor)
+                sql += ' ORDER BY created_at DESC, id DESC' if older else ' ORDER BY created_at, id'
+                sql += ' LIMIT ?'
+                params.append(limit + 1)
+                rows = [dict(row) for row in conn.execute(sql, params).fetchall()]
+        except Exception as e:
+            logger.error(f"Ошибка получения страницы заявок: {e}")
+            return page
+        
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if older:
+            page.update(applications=rows, has_older=more, has_newer=cursor is not None)
+        else:
+            page.update(applications=rows[::-1], has_older=True, has_newer=more)
+        return page
+
+    def get_application(self, application_id: int) -> Optional[Dict]:
+        """Получение заявки по ID вместе с данными пользователя"""
+        try:
+            with self.connections.read() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT a.*, u.telegram_id, u.username, u.first_name, u.last_name
+                    FROM applications a
+                    LEFT JOIN users u ON a.user_id = u.id
+                    WHERE a.id = ?
+                ''', (application_id,))
+                app = cursor.fetchone()
+                return dict(app) if app else None
+        except Exception as e:
+            logger.error(f"Ошибка получения заявки {application_id}: {e}")
+            return None
+    
+    def get_applications_by_ids(self, application_ids: List[int]) -> List[Dict]:
+        """Получение заявок по списку ID (в порядке списка)"""
+        if not application_ids:
+            return []
+        try:
+            with self.connections.read() as conn:
+                cursor = conn.cursor()
+                placeholders = ', '.join('?' * len(application_ids))
+                cursor.execute(f'SELECT * FROM applications WHERE id IN ({placeholders})', list(application_ids))
+                found = {row['id']: dict(row) for row in cursor.fetchall()}
+                return [found[app_id] for app_id in application_ids if app_id in found]
+        except Exception as e:
+            logger.error(f"Ошибка получения заявок по списку: {e}")
+            return []
+    
+    def application_exists(self, application_id: int) -> bool:
+        """Проверка существования заявки"""
+        try:
+            with self.connections.read() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT 1 FROM applications WHERE id = ?', (application_id,))
+                return cursor.fetchone() is not None
+        except Exception as e:
+            logger.error(f"Ошибка проверки заявки {application_id}: {e}")
+            return False
+    
     def get_application_count(self) -> int:
         """Получение количества заявок"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.connections.read() as conn:
                 cursor = conn.cursor()
-                cursor.execute('SELECT COUNT(*) FROM applications')
-                return cursor.fetchone()[0]
+                cursor.execute("SELECT value FROM stats_counters WHERE name = 'applications_total'")
+                row = cursor.fetchone()
+                return row[0] if row else 0
         except Exception as e:
             logger.error(f"Ошибка получения количества заявок: {e}")
             return 0
     
+    def get_stats(self) -> Dict:
+        """Статистика из счетчиков (не зависит от количества строк в таблицах)"""
+        stats = {
+            'users_total': 0,
+            'applications_total': 0,
+            'users_with_applications': 0,
+            'applications_by_status': {}
+        }
+        try:
+            with self.connections.read() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT name, value FROM stats_counters')
+                for name, value in cursor.fetchall():
+                    if name.startswith('status:'):
+                        if value:
+                            stats['applications_by_status'][name[len('status:'):]] = value
+                    else:
+                        stats[name] = value
+        except Exception as e:
+            logger.error(f"Ошибка получения статистики: {e}")
+        return stats
+    
+    def get_funnel(self, days: int) -> Dict:
+        """Воронка заявок за последние days дней из дневных агрегатов"""
+        funnel = {
+            'users_new': 0,
+            'form_started': 0,
+            'form_phone': 0,
+            'form_info': 0,
+            'applications_created': 0,
+            'applications_completed': 0,
+            'completion_median': None
+        }
+        try:
+            with self.connections.read() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT metric, SUM(value) FROM analytics_daily
+                    WHERE day > date('now', ?)
+                    GROUP BY metric
+                ''', (f'-{int(days)} days',))
+                totals = dict(cursor.fetchall())
+        except Exception as e:
+            logger.error(f"Ошибка получения воронки: {e}")
+            return funnel
+
+        for metric in funnel:
+            if metric in totals:
+                funnel[metric] = totals[metric]
+
+        # Медиана по гистограмме: верхняя граница корзины, в которую попадает середина
+        buckets = [(bound, totals.get(f'completion_le_{bound}', 0)) for bound in COMPLETION_BUCKETS]
+        buckets.append((None, totals.get(f'completion_gt_{COMPLETION_BUCKETS[-1]}', 0)))
+        total = sum(count for _, count in buckets)
+        if total:
+            seen = 0
+            for bound, count in buckets:
+                seen += count
+                if seen * 2 >= total:
+                    funnel['completion_median'] = bound if bound is not None else COMPLETION_BUCKETS[-1] + 1
+                    break
+        return funnel
+    
     def get_all_users(self) -> List[Dict]:
         """Получение всех пользователей для рассылки"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.connections.read() as conn:
                 cursor = conn.cursor()
                 cursor.execute('SELECT id, telegram_id, username, first_name FROM users')
                 users = cursor.fetchall()
@@ -158,105 +1191,124 @@ class Database:
             logger.error(f"Ошибка получения пользователей: {e}")
             return []
     
-    def save_user_state(self, user_id: int, state: str, data: str = None):
-        """Сохранение состояния пользователя"""
+    @write_method
+    def save_user_state(self, user_id: int, state: str, **fields):
+        """Сохранение состояния пользователя; fields — поля из STATE_FIELDS"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT OR REPLACE INTO user_states (user_id, state, data, updated_at)
-                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-                ''', (user_id, state, data))
-                conn.commit()
+            record = self._state_record(user_id, state, fields)
+            (yield lambda cursor: self._write_state(cursor, record))
+            self.state_cache.set(user_id, record)
         except Exception as e:
+            self.state_cache.delete(user_id)
             logger.error(f"Ошибка сохранения состояния: {e}")
     
     def get_user_state(self, user_id: int) -> Optional[Dict]:
         """Получение состояния пользователя"""
+        cached = self.state_cache.get(user_id)
+        if cached is not MISSING:
+            return dict(cached) if cached else None
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.connections.read() as conn:
                 cursor = conn.cursor()
                 cursor.execute('SELECT * FROM user_states WHERE user_id = ?', (user_id,))
-                state = cursor.fetchone()
-                return dict(state) if state else None
+                state = self._state_from_row(cursor.fetchone())
+            self.state_cache.set(user_id, state)
+            return dict(state) if state else None
         except Exception as e:
             logger.error(f"Ошибка получения состояния: {e}")
             return None
     
+    @write_method
     def clear_user_state(self, user_id: int):
         """Очистка состояния пользователя"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('DELETE FROM user_states WHERE user_id = ?', (user_id,))
-                conn.commit()
+            (yield lambda cursor: self._delete_state(cursor, user_id))
+            self.state_cache.set(user_id, None)
         except Exception as e:
+            self.state_cache.delete(user_id)
             logger.error(f"Ошибка очистки состояния: {e}")
     
     def get_incomplete_applications(self) -> List[Dict]:
         """Получение незавершенных заявок для напоминаний"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.connections.read() as conn:
                 cursor = conn.cursor()
-                cursor.execute('''
+                cursor.execute(f'''
                     SELECT us.*, u.telegram_id, u.username, u.first_name
                     FROM user_states us
                     JOIN users u ON us.user_id = u.telegram_id
-                    WHERE us.state IN ('application_fio', 'application_phone', 'application_info')
-                    AND us.updated_at < datetime('now', '-24 hours')
-                ''')
+                    WHERE us.state IN {FORM_STATES_SQL}
+                    AND us.updated_at < ?
+                    AND u.blocked_at IS NULL
+                ''', (int(time.time()) - ABANDONED_FORM_AFTER,))
                 incomplete = cursor.fetchall()
-                return [dict(app) for app in incomplete]
+                return [self._state_from_row(app) for app in incomplete]
         except Exception as e:
             logger.error(f"Ошибка получения незавершенных заявок: {e}")
             return []
     
-    def get_users_without_applications(self) -> List[Dict]:
-        """Получение пользователей, которые не оформили заявки"""
+    def count_segment(self, segment: str) -> int:
+        """Размер сегмента"""
+        try:
+            with self.connections.read() as conn:
+                cursor = conn.cursor()
+                if segment == 'all':
+                    cursor.execute("SELECT value FROM stats_counters WHERE name = 'users_total'")
+                elif segment in MATERIALIZED_SEGMENTS:
+                    cursor.execute('SELECT COUNT(*) FROM user_segments WHERE segment = ?', (segment,))
+                elif segment == 'abandoned_form':
+                    cursor.execute(f'''
+                        SELECT COUNT(*) FROM user_states
+                        INDEXED BY idx_user_states_form_updated_at
+                        WHERE state IN {FORM_STATES_SQL}
+                          AND updated_at < ?
+                    ''', (int(time.time()) - ABANDONED_FORM_AFTER,))
+                else:
+                    raise ValueError(f"Неизвестный сегмент: {segment}")
+                row = cursor.fetchone()
+                return row[0] if row else 0
+        except Exception as e:
+            logger.error(f"Ошибка подсчета сегмента {segment}: {e}")
+            return 0
+    
+    def get_segment_users(self, segment: str, after: int = None, limit: int = 100) -> List[Dict]:
+        """Пользователи материализованного сегмента с данными профиля (по возрастанию telegram_id)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.connections.read() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT u.*, 
                            CASE 
-                               WHEN us.state IS NOT NULL THEN us.updated_at
+                               WHEN us.state IS NOT NULL THEN datetime(us.updated_at, 'unixepoch')
                                ELSE u.last_activity
                            END as last_seen
-                    FROM users u
-                    LEFT JOIN applications a ON u.id = a.user_id
+                    FROM user_segments s
+                    JOIN users u ON u.telegram_id = s.telegram_id
                     LEFT JOIN user_states us ON u.telegram_id = us.user_id
-                    WHERE a.id IS NULL
-                    ORDER BY u.last_activity DESC
-                ''')
+                    WHERE s.segment = ? AND s.telegram_id > ?
+                    ORDER BY s.telegram_id
+                    LIMIT ?
+                ''', (segment, after if after is not None else -2 ** 63, limit))
                 users = cursor.fetchall()
                 return [dict(user) for user in users]
         except Exception as e:
-            logger.error(f"Ошибка получения пользователей без заявок: {e}")
+            logger.error(f"Ошибка получения пользователей сегмента {segment}: {e}")
             return []
     
+    @write_method
     def delete_application(self, application_id: int) -> bool:
         """Удаление заявки по ID"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('DELETE FROM applications WHERE id = ?', (application_id,))
-                conn.commit()
-                return cursor.rowcount > 0
+            return (yield lambda cursor: self._delete_application(cursor, application_id))
         except Exception as e:
             logger.error(f"Ошибка удаления заявки {application_id}: {e}")
             return False
     
+    @write_method
     def update_application_status(self, application_id: int, status: str) -> bool:
         """Обновление статуса заявки"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('UPDATE applications SET status = ? WHERE id = ?', (status, application_id))
-                conn.commit()
-                return cursor.rowcount > 0
+            return (yield lambda cursor: self._write_application_status(cursor, application_id, status))
         except Exception as e:
             logger.error(f"Ошибка обновления статуса заявки {application_id}: {e}")
             return False
@@ -264,8 +1316,7 @@ class Database:
     def get_user_by_id(self, user_id: int) -> dict:
         """Получение пользователя по ID"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.connections.read() as conn:
                 cursor = conn.cursor()
                 cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
                 user = cursor.fetchone()
@@ -274,14 +1325,602 @@ class Database:
             logger.error(f"Ошибка получения пользователя {user_id}: {e}")
             return {}
     
+    @staticmethod
+    def _segment_source_sql(segment: str) -> str:
+        """SELECT telegram_id получателей сегмента без заблокировавших бота (для INSERT ... SELECT)"""
+        if segment == 'all':
+            return 'SELECT telegram_id FROM users WHERE blocked_at IS NULL'
+        if segment in MATERIALIZED_SEGMENTS:
+            source = f"SELECT telegram_id FROM user_segments WHERE segment = '{segment}'"
+        elif segment == 'abandoned_form':
+            source = f'''
+                SELECT user_id AS telegram_id FROM user_states INDEXED BY idx_user_states_form_updated_at
+                WHERE state IN {FORM_STATES_SQL}
+                  AND updated_at < CAST(strftime('%s', 'now') AS INTEGER) - {ABANDONED_FORM_AFTER}
+            '''
+        else:
+            raise ValueError(f"Неизвестный сегмент: {segment}")
+        return f'''
+            SELECT telegram_id FROM ({source})
+            WHERE telegram_id NOT IN (SELECT telegram_id FROM users WHERE blocked_at IS NOT NULL)
+        '''
+    
+    @classmethod
+    def _write_broadcast_recipients(cls, cursor, broadcast_id: int, segment: str) -> int:
+        # Список получателей фиксируется в момент запуска рассылки
+        cursor.execute(f'''
+            INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, telegram_id)
+            SELECT ?, telegram_id FROM ({cls._segment_source_sql(segment)})
+        ''', (broadcast_id,))
+        total = cursor.rowcount
+        cursor.execute(
+            "UPDATE broadcasts SET total_count = ?, status = 'pending' WHERE id = ?",
+            (total, broadcast_id)
+        )
+        return total
+    
+    @write_method
+    def create_broadcast(self, message: str, segment: str = 'all', admin_chat_id: int = None,
+                         scheduled_at: str = None, spread_seconds: int = 0,
+                         media: List[Dict] = None) -> Optional[Dict]:
+        """Создание рассылки. Если scheduled_at (UTC) еще не наступило, рассылка ждет
+        своего времени в статусе 'scheduled', иначе получатели фиксируются сразу"""
+        try:
+            self._segment_source_sql(segment)
+            deferred = bool(scheduled_at) and scheduled_at > self._now()
+            
+            def write(cursor):
+                cursor.execute('''
+                    INSERT INTO broadcasts (message, segment, status, admin_chat_id, scheduled_at, spread_seconds, media)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (message, segment, 'scheduled' if deferred else 'pending', admin_chat_id,
+                      scheduled_at, spread_seconds, json.dumps(media) if media else None))
+                broadcast_id = cursor.lastrowid
+                if not deferred:
+                    Database._write_broadcast_recipients(cursor, broadcast_id, segment)
+                cursor.execute('SELECT * FROM broadcasts WHERE id = ?', (broadcast_id,))
+                return dict(cursor.fetchone())
+            
+            return (yield write)
+        except Exception as e:
+            logger.error(f"Ошибка создания рассылки: {e}")
+            return None
+    
+    @write_method
+    def activate_due_broadcasts(self) -> List[Dict]:
+        """Перевод отложенных рассылок, время которых наступило, в очередь на отправку"""
+        try:
+            def write(cursor):
+                cursor.execute('''
+                    SELECT id, segment FROM broadcasts
+                    WHERE status = 'scheduled' AND scheduled_at <= ?
+                    ORDER BY scheduled_at
+                ''', (self._now(),))
+                due = cursor.fetchall()
+                for broadcast in due:
+                    Database._write_broadcast_recipients(cursor, broadcast['id'], broadcast['segment'])
+                return [broadcast['id'] for broadcast in due]
+            
+            broadcast_ids = yield write
+            return [self.get_broadcast(broadcast_id) for broadcast_id in broadcast_ids]
+        except Exception as e:
+            logger.error(f"Ошибка запуска отложенных рассылок: {e}")
+            return []
+    
+    @write_method
+    def save_media_files(self, items: List[Dict]) -> bool:
+        """Сохранение file_id по file_unique_id: [{'type', 'file_id', 'file_unique_id'}, ...]"""
+        if not items:
+            return True
+        try:
+            rows = [(item['file_unique_id'], item['file_id'], item['type']) for item in items]
+            (yield lambda cursor: cursor.executemany('''
+                INSERT INTO media_files (file_unique_id, file_id, media_type) VALUES (?, ?, ?)
+                ON CONFLICT(file_unique_id) DO UPDATE SET
+                    file_id = excluded.file_id,
+                    media_type = excluded.media_type,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', rows))
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения медиафайлов: {e}")
+            return False
+    
+    def get_media_file_ids(self, file_unique_ids: List[str]) -> Dict[str, str]:
+        """Сохраненные file_id по file_unique_id"""
+        if not file_unique_ids:
+            return {}
+        try:
+            with self.connections.read() as conn:
+                cursor = conn.cursor()
+                placeholders = ', '.join('?' * len(file_unique_ids))
+                cursor.execute(
+                    f'SELECT file_unique_id, file_id FROM media_files WHERE file_unique_id IN ({placeholders})',
+                    list(file_unique_ids)
+                )
+                return {row['file_unique_id']: row['file_id'] for row in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"Ошибка получения медиафайлов: {e}")
+            return {}
+    
+    @write_method
+    def cancel_scheduled_broadcast(self, broadcast_id: int) -> bool:
+        """Отмена рассылки, которая еще не началась"""
+        try:
+            return (yield lambda cursor: cursor.execute('''
+                UPDATE broadcasts SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'scheduled'
+            ''', (broadcast_id,)).rowcount > 0)
+        except Exception as e:
+            logger.error(f"Ошибка отмены рассылки {broadcast_id}: {e}")
+            return False
+    
+    def get_broadcast(self, broadcast_id: int) -> Optional[Dict]:
+        """Получение рассылки по ID"""
+        try:
+            with self.connections.read() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT * FROM broadcasts WHERE id = ?', (broadcast_id,))
+                broadcast = cursor.fetchone()
+                return dict(broadcast) if broadcast else None
+        except Exception as e:
+            logger.error(f"Ошибка получения рассылки {broadcast_id}: {e}")
+            return None
+    
+    def get_unfinished_broadcasts(self) -> List[Dict]:
+        """Рассылки, которые нужно продолжить (например, после перезапуска)"""
+        try:
+            with self.connections.read() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT * FROM broadcasts WHERE status IN ('pending', 'running') ORDER BY id")
+                return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Ошибка получения незавершенных рассылок: {e}")
+            return []
+    
+    def get_pending_recipients(self, broadcast_id: int, after: int = None, limit: int = 500) -> List[int]:
+        """Следующая страница получателей рассылки, которым еще не отправлено"""
+        try:
+            with self.connections.read() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT telegram_id FROM broadcast_recipients
+                    WHERE broadcast_id = ? AND status = 'pending' AND telegram_id > ?
+                    ORDER BY telegram_id LIMIT ?
+                ''', (broadcast_id, after if after is not None else -2 ** 63, limit))
+                return [row[0] for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Ошибка получения получателей рассылки {broadcast_id}: {e}")
+            return []
+    
+    @write_method
+    def save_delivery_results(self, broadcast_id: int, results: List[tuple]) -> bool:
+        """Запись результатов доставки пачкой: [(telegram_id, status, error), ...]"""
+        if not results:
+            return True
+        try:
+            sent_at = self._now()
+            sent = sum(1 for _, status, _ in results if status == 'sent')
+            failed = len(results) - sent
+            
+            def write(cursor):
+                cursor.executemany('''
+                    UPDATE broadcast_recipients SET status = ?, error = ?, sent_at = ?
+                    WHERE broadcast_id = ? AND telegram_id = ? AND status = 'pending'
+                ''', [(status, error, sent_at, broadcast_id, telegram_id) for telegram_id, status, error in results])
+                cursor.execute('''
+                    UPDATE broadcasts SET sent_count = sent_count + ?, failed_count = failed_count + ?
+                    WHERE id = ?
+                ''', (sent, failed, broadcast_id))
+            
+            (yield write)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка записи результатов рассылки {broadcast_id}: {e}")
+            return False
+    
+    @write_method
+    def update_broadcast(self, broadcast_id: int, **fields) -> bool:
+        """Обновление полей рассылки (status, progress_message_id)"""
+        allowed = {'status', 'progress_message_id'}
+        fields = {key: value for key, value in fields.items() if key in allowed}
+        if not fields:
+            return False
+        try:
+            assignments = ', '.join(f'{key} = ?' for key in fields)
+            if fields.get('status') in ('done', 'cancelled', 'failed'):
+                assignments += ', finished_at = CURRENT_TIMESTAMP'
+            params = (*fields.values(), broadcast_id)
+            return (yield
+                lambda cursor: cursor.execute(f'UPDATE broadcasts SET {assignments} WHERE id = ?', params).rowcount > 0
+            )
+        except Exception as e:
+            logger.error(f"Ошибка обновления рассылки {broadcast_id}: {e}")
+            return False
+    
+    @write_method
+    def mark_user_blocked(self, telegram_id: int) -> bool:
+        """Отметка пользователя, заблокировавшего бота (рассылки и напоминания его пропускают)"""
+        try:
+            updated = (yield lambda cursor: cursor.execute(
+                'UPDATE users SET blocked_at = CURRENT_TIMESTAMP WHERE telegram_id = ? AND blocked_at IS NULL',
+                (telegram_id,)
+            ).rowcount > 0)
+            self.user_cache.delete(telegram_id)
+            if updated:
+                logger.info(f"Пользователь {telegram_id} заблокировал бота")
+            return updated
+        except Exception as e:
+            logger.error(f"Ошибка отметки блокировки пользователя {telegram_id}: {e}")
+            return False
+    
+    def notify_outbox(self):
+        """Оповещение подписчиков о новых сообщениях в очереди"""
+        for listener in self.outbox_listeners:
+            listener()
+    
+    @write_method
+    def enqueue_message(self, chat_id: int, priority: int, payload: Dict, method: str = 'send_message') -> Optional[int]:
+        """Постановка сообщения в очередь отправки (payload — параметры метода Bot API)"""
+        try:
+            message_id = (yield
+                lambda cursor: Database._write_outbox(cursor, chat_id, priority, payload, method)
+            )
+            self.notify_outbox()
+            return message_id
+        except Exception as e:
+            logger.error(f"Ошибка постановки сообщения в очередь для {chat_id}: {e}")
+            return None
+    
+    def get_outbox_batch(self, limit: int = 10) -> List[Dict]:
+        """Следующие сообщения к отправке: по приоритету, затем по порядку постановки"""
+        try:
+            with self.connections.read() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT id, priority, chat_id, method, payload, attempts FROM outbox
+                    WHERE status = 'pending' AND next_attempt_at <= ?
+                    ORDER BY priority, id LIMIT ?
+                ''', (self._now(), limit))
+                messages = []
+                for row in cursor.fetchall():
+                    message = dict(row)
+                    try:
+                        message['payload'] = json.loads(message['payload'])
+                    except (TypeError, ValueError) as e:
+                        # Сообщение отметит как неотправляемое диспетчер, остальная пачка не теряется
+                        logger.error(f"Некорректные данные сообщения #{message['id']} в очереди: {e}")
+                        message['payload'] = None
+                    messages.append(message)
+                return messages
+        except Exception as e:
+            logger.error(f"Ошибка получения очереди сообщений: {e}")
+            return []
+    
+    @write_method
+    def save_outbox_results(self, results: List[tuple]) -> bool:
+        """Запись результатов отправки: [(id, исход, ошибка, повтор через секунд), ...];
+        исход 'sent', 'retry' (попытка засчитана), 'defer' (отложить без попытки) или 'failed'"""
+        if not results:
+            return True
+        sent = [(message_id,) for message_id, outcome, _, _ in results if outcome == 'sent']
+        retry = [(1 if outcome == 'retry' else 0, error, f'+{delay:.0f} seconds', message_id)
+                 for message_id, outcome, error, delay in results if outcome in ('retry', 'defer')]
+        failed = [(error, message_id) for message_id, outcome, error, _ in results if outcome == 'failed']
+        
+        def write(cursor):
+            # Отправленные сообщения не храним, чтобы очередь оставалась маленькой
+            cursor.executemany('DELETE FROM outbox WHERE id = ?', sent)
+            cursor.executemany('''
+                UPDATE outbox SET attempts = attempts + ?, error = ?,
+                    next_attempt_at = datetime('now', ?)
+                WHERE id = ?
+            ''', retry)
+            cursor.executemany(
+                "UPDATE outbox SET status = 'failed', attempts = attempts + 1, error = ? WHERE id = ?",
+                failed
+            )
+        
+        try:
+            (yield write)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка записи результатов отправки очереди: {e}")
+            return False
+    
+    @write_method
+    def flush_admin_digest(self, admin_ids: List[int], priority: int, build) -> int:
+        """Сводка накопленных заявок: очередь сводки очищается, а сообщение ставится
+        в outbox одной транзакцией. build(digest_id, заявки) возвращает параметры сообщения."""
+        def write(cursor):
+            cursor.execute('''
+                SELECT a.id, a.name, a.phone FROM admin_digest_queue q
+                JOIN applications a ON a.id = q.application_id
+                ORDER BY a.id
+            ''')
+            applications = [dict(row) for row in cursor.fetchall()]
+            cursor.execute('DELETE FROM admin_digest_queue')
+            if not applications:
+                return 0
+            cursor.execute(
+                'INSERT INTO admin_digests (application_ids) VALUES (?)',
+                (json.dumps([app['id'] for app in applications]),)
+            )
+            payload = build(cursor.lastrowid, applications)
+            for admin_id in admin_ids:
+                Database._write_outbox(cursor, admin_id, priority, payload)
+            return len(applications)
+        
+        try:
+            count = (yield write)
+            if count:
+                self.notify_outbox()
+            return count
+        except Exception as e:
+            logger.error(f"Ошибка формирования сводки заявок: {e}")
+            return 0
+    
+    def get_admin_digest(self, digest_id: int) -> List[int]:
+        """ID заявок сводки"""
+        try:
+            with self.connections.read() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT application_ids FROM admin_digests WHERE id = ?', (digest_id,))
+                digest = cursor.fetchone()
+                return json.loads(digest['application_ids']) if digest else []
+        except Exception as e:
+            logger.error(f"Ошибка получения сводки {digest_id}: {e}")
+            return []
+    
     def delete_user(self, telegram_id: int) -> bool:
         """Удаление пользователя"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.connections.write() as conn:
                 cursor = conn.cursor()
                 cursor.execute('DELETE FROM users WHERE telegram_id = ?', (telegram_id,))
-                conn.commit()
-                return cursor.rowcount > 0
+                deleted = cursor.rowcount > 0
+            self.user_cache.delete(telegram_id)
+            return deleted
         except Exception as e:
             logger.error(f"Ошибка удаления пользователя {telegram_id}: {e}")
             return False
+
+class UnitOfWork:
+    """Единица работы на одно обновление: пользователь и его состояние загружаются
+    один раз, а все изменения записываются одной транзакцией в flush()"""
+
+    def __init__(self, db: Database, telegram_id: int):
+        self.db = db
+        self.telegram_id = telegram_id
+        self.user: Optional[Dict] = None
+        self.state: Optional[Dict] = None
+        self._ops = []
+
+    def load(self) -> 'UnitOfWork':
+        """Загрузка пользователя и состояния"""
+        self.user = self.db.get_user(self.telegram_id)
+        self.state = self.db.get_user_state(self.telegram_id)
+        return self
+
+    @property
+    def state_name(self) -> Optional[str]:
+        """Название текущего состояния"""
+        return self.state['state'] if self.state else None
+
+    @property
+    def state_ref_id(self) -> Optional[int]:
+        """Объект, к которому относится состояние (например, id заявки для ответа)"""
+        return self.state['ref_id'] if self.state else None
+
+    def _stage(self, op, on_commit=None) -> int:
+        self._ops.append((op, on_commit))
+        # Позиция результата операции в списке, который возвращает flush()
+        return len(self._ops) - 1
+
+    def add_user(self, username: str = None, first_name: str = None, last_name: str = None):
+        """Добавление или обновление текущего пользователя"""
+        def on_commit(user):
+            self.user = user
+            self.db.user_cache.set(self.telegram_id, user)
+        self._stage(
+            lambda cursor: Database._write_user(cursor, self.telegram_id, username, first_name, last_name),
+            on_commit
+        )
+
+    def save_state(self, state: str, **fields):
+        """Сохранение состояния текущего пользователя; fields — поля из STATE_FIELDS,
+        не переданные поля очищаются"""
+        self.state = Database._state_record(self.telegram_id, state, fields)
+        snapshot = dict(self.state)
+        self._stage(
+            lambda cursor: Database._write_state(cursor, snapshot),
+            lambda _: self.db.state_cache.set(self.telegram_id, snapshot)
+        )
+
+    def touch_state(self):
+        """Обновление времени текущего состояния без изменения полей"""
+        if not self.state:
+            return
+        self.state = dict(self.state, updated_at=int(time.time()))
+        updated_at = self.state['updated_at']
+        # Состояние могло измениться после загрузки (например, обработчиком сообщения
+        # пользователя), поэтому кэш сбрасывается, а не перезаписывается снимком
+        self._stage(
+            lambda cursor: Database._touch_state(cursor, self.telegram_id, updated_at),
+            lambda _: self.db.state_cache.delete(self.telegram_id)
+        )
+
+    def clear_state(self):
+        """Очистка состояния текущего пользователя"""
+        self.state = None
+        self._stage(
+            lambda cursor: Database._delete_state(cursor, self.telegram_id),
+            lambda _: self.db.state_cache.set(self.telegram_id, None)
+        )
+
+    def add_application(self, name: str, phone: str, additional_info: str = None, status: str = 'Новая'):
+        """Добавление заявки от текущего пользователя"""
+        user_id = self.user['id']
+        return self._stage(lambda cursor: Database._write_application(cursor, user_id, name, phone, additional_info, status))
+
+    def record_metric(self, metric: str, amount: int = 1):
+        """Увеличение дневного счетчика аналитики"""
+        self._stage(lambda cursor: Database._write_metric(cursor, metric, amount))
+
+    def update_application_status(self, application_id: int, status: str):
+        """Обновление статуса заявки"""
+        return self._stage(lambda cursor: Database._write_application_status(cursor, application_id, status))
+
+    def delete_application(self, application_id: int):
+        """Удаление заявки"""
+        self._stage(lambda cursor: Database._delete_application(cursor, application_id))
+
+    def enqueue(self, chat_id: int, priority: int, payload, method: str = 'send_message'):
+        """Постановка сообщения в очередь отправки в той же транзакции.
+        payload — параметры метода Bot API или функция, строящая их по результатам
+        ранее добавленных операций (например, по созданной заявке)"""
+        def op(cursor, results):
+            params = payload(results) if callable(payload) else payload
+            return Database._write_outbox(cursor, chat_id, priority, params, method)
+        op.uses_results = True
+        return self._stage(op, lambda _: self.db.notify_outbox())
+
+    def add_to_admin_digest(self, app_index: int):
+        """Отложить уведомление о заявке до следующей сводки (app_index — позиция add_application)"""
+        def op(cursor, results):
+            cursor.execute(
+                'INSERT OR IGNORE INTO admin_digest_queue (application_id) VALUES (?)',
+                (results[app_index]['id'],)
+            )
+        op.uses_results = True
+        return self._stage(op)
+
+    def take(self):
+        """Извлечение накопленных операций: (операция записи, функция после коммита)"""
+        ops, self._ops = self._ops, []
+        if not ops:
+            return None, None
+
+        def write(cursor):
+            results = []
+            for op, _ in ops:
+                results.append(op(cursor, results) if getattr(op, 'uses_results', False) else op(cursor))
+            return results
+
+        def committed(results):
+            # Кэш обновляется только после успешной фиксации транзакции
+            for (_, on_commit), result in zip(ops, results):
+                if on_commit:
+                    on_commit(result)
+            return results
+
+        return write, committed
+
+    def flush(self) -> list:
+        """Запись накопленных изменений одной транзакцией; возвращает результаты операций"""
+        write, committed = self.take()
+        if write is None:
+            return []
+        return committed(self.db.execute_write(write))
+
+    def rollback(self):
+        """Отмена накопленных изменений (в базу и кэш еще ничего не записано)"""
+        self._ops = []
+
+    def __enter__(self) -> 'UnitOfWork':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.rollback()
+
+class AsyncDatabase:
+    """Асинхронный интерфейс к Database: запросы выполняются в отдельном потоке,
+    не блокируя цикл событий. Синхронный API доступен через атрибут sync."""
+
+    def __init__(self, db: Database = None, max_pending: int = DB_MAX_PENDING):
+        self.sync = db or Database()
+        self.max_pending = max(1, max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='database')
+        self._slots = None
+
+    async def run(self, func, *args, **kwargs):
+        """Выполнение синхронной функции в потоке базы данных"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self.sync, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        steps = getattr(attr, 'write_steps', None)
+        if steps is not None and self.sync.writer is not None:
+            # При групповом коммите поток базы данных не должен ждать записи: иначе
+            # в каждую пачку попадает одна операция, а чтения стоят в очереди за ней
+            async def call(*args, **kwargs):
+                return await self.drive_write(steps(self.sync, *args, **kwargs))
+        else:
+            async def call(*args, **kwargs):
+                return await self.run(attr, *args, **kwargs)
+
+        call.__name__ = name
+        call.__doc__ = attr.__doc__
+        return call
+
+    @asynccontextmanager
+    async def unit_of_work(self, telegram_id: int):
+        """Единица работы для обновления: изменения записываются при выходе,
+        при исключении отбрасываются"""
+        uow = await self.run(self.sync.unit_of_work, telegram_id)
+        try:
+            yield uow
+        except BaseException:
+            uow.rollback()
+            raise
+        await self.flush(uow)
+
+    async def flush(self, uow: UnitOfWork) -> list:
+        """Досрочная запись изменений единицы работы"""
+        write, committed = uow.take()
+        if write is None:
+            return []
+        return committed(await self.execute_write(write))
+
+    async def execute_write(self, op):
+        """Выполнение операции записи; при групповом коммите поток базы данных не занимается ожиданием"""
+        if self.sync.writer is not None:
+            return await asyncio.wrap_future(self.sync.writer.submit(op))
+        return await self.run(self.sync.execute_write, op)
+
+    async def drive_write(self, steps):
+        """Выполнение метода записи: код метода — в потоке базы данных, ожидание записи — в цикле событий"""
+        done, value = await self.run(write_step, steps)
+        while not done:
+            try:
+                result = await self.execute_write(value)
+            except Exception as e:
+                done, value = await self.run(write_step, steps, None, e)
+            else:
+                done, value = await self.run(write_step, steps, result)
+        return value
+
+    async def flush_activity(self) -> int:
+        """Запись накопленной активности пользователей"""
+        return await self.drive_write(self.sync.activity.flush_steps())
+
+    async def run_activity_flusher(self, interval: float = ACTIVITY_FLUSH_INTERVAL):
+        """Периодическая запись активности пользователей"""
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush_activity()
+
+    async def close(self):
+        """Завершение потока базы данных и закрытие соединений"""
+        await self.run(self.sync.close)
+        self._executor.shutdown(wait=True)
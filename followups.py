@@ -0,0 +1,48 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Hashable
+
+logger = logging.getLogger(__name__)
+
+class FollowUpScheduler:
+    """Отложенные действия после ответа обработчика (например, возврат в админ-меню).
+    На каждый чат хранится одно действие: новое действие или новое обновление
+    из этого чата отменяет запланированное."""
+
+    def __init__(self):
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+
+    def schedule(self, key: Hashable, delay: float, callback: Callable[..., Awaitable], *args) -> asyncio.Task:
+        """Запуск callback(*args) через delay секунд"""
+        self.cancel(key)
+        task = asyncio.create_task(self._run(key, delay, callback, args))
+        self._tasks[key] = task
+        return task
+
+    async def _run(self, key: Hashable, delay: float, callback: Callable[..., Awaitable], args: tuple):
+        try:
+            await asyncio.sleep(delay)
+            # После паузы действие уже нельзя отменить новым обновлением
+            if self._tasks.get(key) is asyncio.current_task():
+                del self._tasks[key]
+            await callback(*args)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка отложенного действия для {key}: {e}")
+
+    def cancel(self, key: Hashable) -> bool:
+        """Отмена запланированного действия; True, если оно было"""
+        task = self._tasks.pop(key, None)
+        if task is None:
+            return False
+        task.cancel()
+        return True
+
+    async def shutdown(self):
+        """Отмена всех запланированных действий"""
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
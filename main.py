@@ -24,7 +24,7 @@ class BotManager:
             logger.info("Запуск Telegram бота...")
             
             # Запускаем систему напоминаний как задачу
-            self.reminder_task = asyncio.create_task(start_reminder_system())
+            self.reminder_task = asyncio.create_task(start_reminder_system(self.bot.db))
             
             # Запускаем бота
             await self.bot.run_async()
@@ -54,6 +54,9 @@ class BotManager:
                 await self.bot.application.stop()
                 await self.bot.application.shutdown()
             
+            # Закрываем соединения с базой данных
+            await self.bot.db.close()
+            
             logger.info("Бот остановлен")
             
         except Exception as e:
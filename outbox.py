@@ -0,0 +1,116 @@
+import asyncio
+import logging
+from typing import Dict, List
+
+from telegram import Bot, InlineKeyboardMarkup, ReplyKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+from config import ADMIN_USER_IDS, OUTBOX_CONCURRENCY, OUTBOX_POLL_INTERVAL, OUTBOX_MAX_ATTEMPTS, API_CIRCUIT_RESET_TIMEOUT
+from database import AsyncDatabase
+from ratelimit import RateLimiter
+from retry import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты очереди: меньшее значение отправляется раньше
+PRIORITY_REPLY = 0
+PRIORITY_ADMIN = 1
+PRIORITY_REMINDER = 2
+PRIORITY_BROADCAST = 3
+
+class OutboxDispatcher:
+    """Отправка сообщений из очереди outbox по приоритетам через общий ограничитель частоты"""
+
+    def __init__(self, db: AsyncDatabase, limiter: RateLimiter = None,
+                 concurrency: int = OUTBOX_CONCURRENCY, poll_interval: float = OUTBOX_POLL_INTERVAL,
+                 admin_ids: List[int] = None):
+        self.db = db
+        self.admin_ids = ADMIN_USER_IDS if admin_ids is None else admin_ids
+        self.limiter = limiter or RateLimiter()
+        self.concurrency = max(1, concurrency)
+        self.poll_interval = poll_interval
+        self._wakeup = None
+
+    async def run(self, bot: Bot):
+        """Цикл диспетчера: после каждой пачки очередь перечитывается,
+        поэтому новые срочные сообщения обгоняют менее приоритетные"""
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        listener = lambda: loop.call_soon_threadsafe(self._wakeup.set)
+        self.db.outbox_listeners.append(listener)
+        try:
+            while True:
+                try:
+                    self._wakeup.clear()
+                    batch = await self.db.get_outbox_batch(self.concurrency)
+                    if not batch:
+                        try:
+                            await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+                    results = await asyncio.gather(*(self._send(bot, message) for message in batch))
+                    await self.db.save_outbox_results(results)
+                    await self._report_failed_replies(batch, results)
+                except Exception as e:
+                    # Диспетчер не должен останавливаться: иначе перестанут уходить все ответы
+                    logger.error(f"Ошибка в цикле очереди сообщений: {e}")
+                    await asyncio.sleep(self.poll_interval)
+        finally:
+            self.db.outbox_listeners.remove(listener)
+
+    async def _send(self, bot: Bot, message: Dict) -> tuple:
+        """Отправка одного сообщения: (id, исход, ошибка, повтор через секунд)"""
+        message_id = message['id']
+        try:
+            await self.limiter.acquire(message['chat_id'], message['priority'])
+            await getattr(bot, message['method'])(chat_id=message['chat_id'], **self._decode(message['payload'], bot))
+            return message_id, 'sent', None, 0
+        except RetryAfter as e:
+            # Лимит превышен для всего бота и не снят повторами: откладываем, попытка не считается
+            self.limiter.pause(float(e.retry_after))
+            return message_id, 'defer', str(e), e.retry_after
+        except CircuitOpenError as e:
+            # API недоступен: ждем пробного запроса, попытка не считается
+            return message_id, 'defer', str(e), API_CIRCUIT_RESET_TIMEOUT
+        except (Forbidden, BadRequest) as e:
+            logger.error(f"Сообщение #{message_id} для {message['chat_id']} не может быть доставлено: {e}")
+            return message_id, 'failed', str(e), 0
+        except NetworkError as e:
+            # Быстрые повторы уже выполнены политикой повторов, здесь — повтор позже
+            if message['attempts'] + 1 >= OUTBOX_MAX_ATTEMPTS:
+                logger.error(f"Сообщение #{message_id} для {message['chat_id']} не отправлено после {OUTBOX_MAX_ATTEMPTS} попыток: {e}")
+                return message_id, 'failed', str(e), 0
+            return message_id, 'retry', str(e), min(2 ** message['attempts'] * 5, 600)
+        except TelegramError as e:
+            logger.error(f"Ошибка отправки сообщения #{message_id} для {message['chat_id']}: {e}")
+            return message_id, 'failed', str(e), 0
+        except Exception as e:
+            # Некорректные параметры сообщения: повтор не поможет
+            logger.error(f"Сообщение #{message_id} для {message['chat_id']} не может быть отправлено: {e}")
+            return message_id, 'failed', str(e), 0
+
+    async def _report_failed_replies(self, batch: List[Dict], results: List[tuple]):
+        """Уведомление администраторов об ответах пользователям, которые не удалось доставить"""
+        for message, (_, outcome, error, _) in zip(batch, results):
+            if outcome != 'failed' or message['priority'] != PRIORITY_REPLY:
+                continue
+            payload = message['payload'] if isinstance(message['payload'], dict) else {}
+            title = str(payload.get('text', '')).split('\n', 1)[0]
+            notice = f"⚠️ Ответ пользователю {message['chat_id']} не доставлен: {error}\n{title}".rstrip()
+            for admin_id in self.admin_ids:
+                await self.db.enqueue_message(admin_id, PRIORITY_ADMIN, {'text': notice})
+
+    @staticmethod
+    def _decode(payload: Dict, bot: Bot) -> Dict:
+        """Восстановление клавиатуры из JSON"""
+        if not isinstance(payload, dict):
+            raise ValueError("некорректные параметры сообщения")
+        markup = payload.get('reply_markup')
+        if isinstance(markup, dict):
+            payload = dict(payload)
+            if 'inline_keyboard' in markup:
+                payload['reply_markup'] = InlineKeyboardMarkup.de_json(markup, bot)
+            else:
+                payload['reply_markup'] = ReplyKeyboardMarkup.de_json(markup, bot)
+        return payload
@@ -0,0 +1,100 @@
+import io
+from typing import AsyncIterator, List, Optional, Tuple
+
+from telegram import Bot
+from telegram.constants import MessageLimit, ParseMode
+
+from config import LISTING_MAX_MESSAGES
+
+def message_length(text: str) -> int:
+    """Длина текста так, как ее считает Telegram (в единицах UTF-16)"""
+    return len(text.encode('utf-16-le')) // 2
+
+class MessagePacker:
+    """Склейка записей в сообщения до лимита длины Telegram.
+    Записи передаются уже экранированными, поэтому запас на экранирование учтен;
+    сообщения разрезаются только по границам записей."""
+
+    def __init__(self, header: str = '', limit: int = MessageLimit.MAX_TEXT_LENGTH):
+        self.header = header
+        self.limit = limit
+        self._parts: List[str] = []
+        self._length = 0
+
+    @property
+    def empty(self) -> bool:
+        """Нет записей, ожидающих отправки"""
+        return not self._parts
+
+    def add(self, record: str) -> List[str]:
+        """Добавление записи; возвращает сообщения, которые уже заполнены"""
+        ready = []
+        length = message_length(record)
+        if self._parts and self._length + length > self.limit:
+            ready.append(self._take())
+        if not self._parts and self.header:
+            self._parts.append(self.header)
+            self._length = message_length(self.header)
+            self.header = ''
+        if self._length + length > self.limit:
+            # Запись длиннее сообщения: режем ее, не оставляя висящий символ экранирования
+            record = self._truncate(record, self.limit - self._length)
+            length = message_length(record)
+        self._parts.append(record)
+        self._length += length
+        return ready
+
+    def flush(self) -> List[str]:
+        """Последнее неполное сообщение"""
+        return [self._take()] if self._parts else []
+
+    def _take(self) -> str:
+        message = ''.join(self._parts)
+        self._parts = []
+        self._length = 0
+        return message
+
+    @staticmethod
+    def _truncate(record: str, limit: int) -> str:
+        record = record[:max(0, limit - 1)]
+        while message_length(record) > limit - 1:
+            record = record[:-1]
+        return record.rstrip('\\') + '…'
+
+async def send_listing(bot: Bot, chat_id: int, header: str, records: AsyncIterator[Tuple[str, str]],
+                       filename: str, caption: str, max_messages: int = LISTING_MAX_MESSAGES,
+                       parse_mode: Optional[str] = ParseMode.MARKDOWN) -> int:
+    """Отправка списка наименьшим числом запросов. records — пары (запись для сообщения,
+    запись для файла), читаются потоком. Если список не помещается в max_messages
+    сообщений, он целиком отправляется одним файлом. Возвращает число записей."""
+    packer = MessagePacker(header)
+    messages: List[str] = []
+    plain: List[str] = []
+    document = None
+    count = 0
+    async for formatted, text in records:
+        count += 1
+        if document is not None:
+            document.write(text.encode('utf-8'))
+            continue
+        messages.extend(packer.add(formatted))
+        plain.append(text)
+        if len(messages) + (0 if packer.empty else 1) > max_messages:
+            # Сообщений будет слишком много: дальше записи идут в файл
+            document = io.BytesIO()
+            for line in plain:
+                document.write(line.encode('utf-8'))
+            messages, plain = [], []
+
+    if document is None:
+        for message in messages + packer.flush():
+            await bot.send_message(chat_id=chat_id, text=message, parse_mode=parse_mode)
+        return count
+
+    await bot.send_document(
+        chat_id=chat_id,
+        document=document.getvalue(),
+        filename=filename,
+        caption=f"{caption}: {count}"
+    )
+    return count
@@ -0,0 +1,69 @@
+import asyncio
+import time
+from collections import Counter
+from typing import Dict, Hashable, Optional
+
+from config import BROADCAST_RATE, BROADCAST_BURST, BROADCAST_PER_CHAT_INTERVAL
+
+class RateLimiter:
+    """Ограничитель частоты отправки: корзина токенов на общий лимит бота
+    и минимальный интервал между сообщениями в один чат. Токены достаются
+    сначала ожидающим с меньшим номером приоритета."""
+
+    # Порог, после которого из словаря чатов удаляются устаревшие записи
+    MAX_TRACKED_CHATS = 10000
+
+    def __init__(self, rate: float = BROADCAST_RATE, burst: int = BROADCAST_BURST,
+                 per_chat_interval: float = BROADCAST_PER_CHAT_INTERVAL):
+        self.rate = max(rate, 0.001)
+        self.capacity = max(1, burst)
+        self.per_chat_interval = per_chat_interval
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._chat_next: Dict[Hashable, float] = {}
+        self._waiting = Counter()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, chat_id: Optional[Hashable] = None, priority: int = 0):
+        """Ожидание разрешения на отправку одного сообщения"""
+        if chat_id is not None and self.per_chat_interval > 0:
+            await self._acquire_chat(chat_id)
+
+        self._waiting[priority] += 1
+        try:
+            while True:
+                async with self._lock:
+                    now = time.monotonic()
+                    wait = self._paused_until - now
+                    if wait <= 0:
+                        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                        self._updated = now
+                        if any(count for level, count in self._waiting.items() if level < priority):
+                            # Уступаем более приоритетным отправкам
+                            wait = 1 / self.rate
+                        elif self._tokens >= 1:
+                            self._tokens -= 1
+                            return
+                        else:
+                            wait = (1 - self._tokens) / self.rate
+                await asyncio.sleep(wait)
+        finally:
+            self._waiting[priority] -= 1
+
+    async def _acquire_chat(self, chat_id: Hashable):
+        # Резервируем ближайший свободный слот чата, чтобы параллельные отправки не столкнулись
+        now = time.monotonic()
+        slot = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = slot + self.per_chat_interval
+        if len(self._chat_next) > self.MAX_TRACKED_CHATS:
+            self._chat_next = {key: value for key, value in self._chat_next.items() if value > now}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, seconds: float):
+        """Приостановка всех отправок (ответ RetryAfter от Telegram)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        # После паузы не отправляем накопленную пачку разом
+        self._tokens = 0.0
+        self._updated = self._paused_until
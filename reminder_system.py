@@ -1,44 +1,31 @@
 import asyncio
 import logging
-from datetime import datetime, timedelta
-from telegram import Bot
-from config import BOT_TOKEN, MESSAGES, ADMIN_USER_IDS
-from database import Database
+from config import MESSAGES
+from database import AsyncDatabase
+from outbox import PRIORITY_REMINDER
 
 logger = logging.getLogger(__name__)
 
 class ReminderSystem:
-    def __init__(self):
-        self.bot = Bot(token=BOT_TOKEN) if BOT_TOKEN else None
-        self.db = Database()
+    def __init__(self, db: AsyncDatabase = None):
+        self.db = db or AsyncDatabase()
         self.running = False
     
     async def send_reminders(self):
-        """Отправка напоминаний пользователям с незавершенными заявками"""
-        if not self.bot:
-            logger.error("Бот не инициализирован для отправки напоминаний")
-            return
-        
+        """Отправка напоминаний пользователям с незавершенными заявками
+        (напоминания ставятся в очередь, отправляет их диспетчер бота)"""
         try:
             # Получаем пользователей с незавершенными заявками
-            incomplete_applications = self.db.get_incomplete_applications()
+            incomplete_applications = await self.db.get_incomplete_applications()
             
             for app in incomplete_applications:
                 try:
-                    # Отправляем напоминание
-                    await self.bot.send_message(
-                        chat_id=app['user_id'],
-                        text=MESSAGES['reminder']
-                    )
-                    
-                    # Обновляем время последней активности
-                    self.db.save_user_state(
-                        app['user_id'], 
-                        app['state'], 
-                        app['data']
-                    )
+                    # Ставим напоминание в очередь и обновляем время состояния одной транзакцией
+                    async with self.db.unit_of_work(app['user_id']) as uow:
+                        uow.enqueue(app['user_id'], PRIORITY_REMINDER, {'text': MESSAGES['reminder']})
+                        uow.touch_state()
                     
-                    logger.info(f"Напоминание отправлено пользователю {app['user_id']}")
+                    logger.info(f"Напоминание поставлено в очередь для пользователя {app['user_id']}")
                     
                 except Exception as e:
                     logger.error(f"Ошибка отправки напоминания пользователю {app['user_id']}: {e}")
@@ -69,11 +56,7 @@ class ReminderSystem:
         logger.info("Система напоминаний остановлена")
 
 # Функция для запуска системы напоминаний в отдельном потоке
-async def start_reminder_system():
+async def start_reminder_system(db: AsyncDatabase = None):
     """Запуск системы напоминаний"""
-    reminder_system = ReminderSystem()
+    reminder_system = ReminderSystem(db)
     await reminder_system.run_reminder_loop()
-
-if __name__ == "__main__":
-    # Для тестирования системы напоминаний
-    asyncio.run(start_reminder_system())
@@ -0,0 +1,115 @@
+from typing import Dict, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+
+from cache import LRUCache, MISSING
+from config import BUTTONS, SEGMENTS, CARD_CACHE_MAX_ENTRIES, DB_CACHE_TTL
+from router import callback_data
+
+# Экранирование Markdown за один проход вместо замены по каждому символу
+MARKDOWN_ESCAPE = str.maketrans({char: f'\\{char}' for char in '_*[]()~`>#+-=|{}.!'})
+
+def escape_markdown(text: str) -> str:
+    """Экранирование специальных символов Markdown"""
+    if not text:
+        return text
+    return text.translate(MARKDOWN_ESCAPE)
+
+def status_emoji(status: str) -> str:
+    """Значок статуса заявки"""
+    return "🆕" if status == 'Новая' else "✅" if status == 'Выполнена' else "❓"
+
+# Клавиатуры не зависят от пользователя, кроме роли; объекты Telegram неизменяемы,
+# поэтому создаются один раз и переиспользуются
+USER_MENU_KEYBOARD = ReplyKeyboardMarkup([[KeyboardButton(BUTTONS['apply'])]], resize_keyboard=True)
+ADMIN_MENU_KEYBOARD = ReplyKeyboardMarkup(
+    [[KeyboardButton(BUTTONS['apply'])], [KeyboardButton(BUTTONS['admin_panel'])]],
+    resize_keyboard=True
+)
+ADMIN_PANEL_KEYBOARD = ReplyKeyboardMarkup(
+    [
+        [KeyboardButton("📊 Статистика"), KeyboardButton("📨 Рассылка")],
+        [KeyboardButton("📋 Все заявки"), KeyboardButton("👥 Все пользователи")],
+        [KeyboardButton("🗑️ Удалить заявку")]
+    ],
+    resize_keyboard=True
+)
+ADMIN_PANEL_TEXT = "🔧 **Панель администратора**\n\nВыберите действие:"
+
+# Выбор сегмента и времени рассылки
+BROADCAST_SEGMENT_KEYBOARD = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(label, callback_data=callback_data("segment", segment))] for segment, label in SEGMENTS.items()]
+    + [[InlineKeyboardButton("❌ Отменить рассылку", callback_data=callback_data("bcancel"))]]
+)
+BROADCAST_SCHEDULE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🚀 Отправить сейчас", callback_data=callback_data("bsched", 0))],
+    [InlineKeyboardButton("⏱ В течение часа", callback_data=callback_data("bsched", 60)),
+     InlineKeyboardButton("⏱ В течение 2 часов", callback_data=callback_data("bsched", 120))],
+    [InlineKeyboardButton("❌ Отменить рассылку", callback_data=callback_data("bcancel"))]
+])
+
+def main_menu_keyboard(is_admin: bool) -> ReplyKeyboardMarkup:
+    """Клавиатура главного меню для роли"""
+    return ADMIN_MENU_KEYBOARD if is_admin else USER_MENU_KEYBOARD
+
+# Шаблоны карточки заявки: поля подставляются уже экранированными
+CARD_BODY_TEMPLATE = (
+    "👤 **Пользователь:** {first_name} (@{username})\n"
+    "🔥 **ФИО:** {name}\n"
+    "📞 **Телефон:** {phone}\n"
+    "💬 **Запрос:** {additional_info}\n"
+    "🕐 **Дата:** {created_at}\n"
+    "📊 **Статус:** {status_emoji} {status}"
+)
+CARD_TEMPLATE = "📧 **Заявка #{id}**\n\n" + CARD_BODY_TEMPLATE
+NEW_APPLICATION_TEMPLATE = "🆕 **Новая заявка!**\n\n📄 **Заявка #{id}**\n" + CARD_BODY_TEMPLATE
+
+# Готовые карточки: app_id -> ((статус, вид), текст, клавиатура)
+card_cache = LRUCache(CARD_CACHE_MAX_ENTRIES, DB_CACHE_TTL)
+
+def application_keyboard(app_id: int) -> InlineKeyboardMarkup:
+    """Кнопки действий с заявкой"""
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("💬 Ответить", callback_data=callback_data("reply", app_id)),
+            InlineKeyboardButton("✅ Завершить", callback_data=callback_data("complete", app_id))
+        ],
+        [
+            InlineKeyboardButton("🗑️ Удалить", callback_data=callback_data("delete", app_id))
+        ]
+    ])
+
+def cached_application_card(app: Dict, new: bool = False):
+    """Готовая карточка из кэша или None, если ее нужно построить"""
+    cached = card_cache.get(app['id'])
+    if cached is MISSING or cached[0] != (app.get('status'), new):
+        return None
+    return cached[1], cached[2]
+
+def render_application_card(app: Dict, first_name: str, username: str,
+                            new: bool = False) -> Tuple[str, InlineKeyboardMarkup]:
+    """Текст и клавиатура карточки заявки (new — уведомление о новой заявке)"""
+    cached = cached_application_card(app, new)
+    if cached is not None:
+        return cached
+
+    status = app.get('status') or 'Новая'
+    template = NEW_APPLICATION_TEMPLATE if new else CARD_TEMPLATE
+    text = template.format(
+        id=app['id'],
+        first_name=escape_markdown(first_name or 'Не указан'),
+        username=escape_markdown(username or 'username'),
+        name=escape_markdown(app['name']),
+        phone=escape_markdown(app['phone']),
+        additional_info=escape_markdown(app['additional_info'] or 'не указано'),
+        created_at=app['created_at'],
+        status_emoji=status_emoji(status),
+        status=status
+    )
+    keyboard = application_keyboard(app['id'])
+    card_cache.set(app['id'], ((app.get('status'), new), text, keyboard))
+    return text, keyboard
+
+def invalidate_application_card(app_id: int):
+    """Сброс карточки после смены статуса или удаления заявки"""
+    card_cache.delete(app_id)
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Callable, Coroutine, Dict, Optional
+
+from telegram.error import (
+    BadRequest, ChatMigrated, Conflict, Forbidden, InvalidToken, NetworkError, RetryAfter
+)
+from telegram.ext import BaseRateLimiter
+
+from config import (
+    API_RETRY_MAX_ATTEMPTS, API_RETRY_BASE_DELAY, API_RETRY_MAX_DELAY,
+    API_CIRCUIT_FAILURE_THRESHOLD, API_CIRCUIT_RESET_TIMEOUT
+)
+from ratelimit import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, которые не исчезнут при повторе
+PERMANENT_ERRORS = (BadRequest, Forbidden, InvalidToken, Conflict, ChatMigrated)
+
+class CircuitOpenError(NetworkError):
+    """API Telegram недоступен: запросы отклоняются до истечения паузы"""
+
+class CircuitBreaker:
+    """Размыкатель: после серии сетевых ошибок запросы отклоняются сразу,
+    по истечении паузы пропускается один пробный запрос"""
+
+    def __init__(self, failure_threshold: int = API_CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = API_CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_in_flight = False
+
+    @property
+    def is_open(self) -> bool:
+        """Разомкнут ли размыкатель"""
+        return self.opened_at is not None
+
+    def before_request(self):
+        """Проверка перед запросом; при разомкнутом состоянии выбрасывает CircuitOpenError"""
+        if self.opened_at is None:
+            return
+        if time.monotonic() - self.opened_at < self.reset_timeout or self._probe_in_flight:
+            raise CircuitOpenError("API Telegram временно недоступен")
+        self._probe_in_flight = True
+
+    def record_success(self):
+        """Успешный запрос замыкает размыкатель"""
+        if self.opened_at is not None:
+            logger.info("Связь с API Telegram восстановлена")
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        """Сетевая ошибка; после порога размыкатель размыкается"""
+        self.failures += 1
+        if self._probe_in_flight or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self._probe_in_flight:
+                logger.warning(f"API Telegram недоступен, запросы приостановлены на {self.reset_timeout} сек.")
+            self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def release_probe(self):
+        """Пробный запрос завершился без вердикта о доступности API"""
+        self._probe_in_flight = False
+
+class RetryPolicy(BaseRateLimiter[None]):
+    """Единая политика повторов для всех запросов бота к API Telegram:
+    - RetryAfter — пауза ровно на retry_after (и для общего ограничителя частоты), затем повтор;
+    - сетевые ошибки и таймауты — повтор с экспоненциальной задержкой со случайным разбросом;
+    - постоянные ошибки (BadRequest, Forbidden, ...) — без повторов;
+    при Forbidden от личного чата вызывается on_blocked(chat_id)."""
+
+    def __init__(self, limiter: RateLimiter = None,
+                 on_blocked: Callable[[int], Coroutine[Any, Any, Any]] = None,
+                 max_attempts: int = API_RETRY_MAX_ATTEMPTS, base_delay: float = API_RETRY_BASE_DELAY,
+                 max_delay: float = API_RETRY_MAX_DELAY, breaker: CircuitBreaker = None):
+        self.limiter = limiter
+        self.on_blocked = on_blocked
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def backoff(self, attempt: int) -> float:
+        """Задержка перед повтором: экспонента с полным случайным разбросом"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def process_request(self, callback, args, kwargs, endpoint: str, data: Dict[str, Any],
+                              rate_limit_args: None):
+        attempt = 0
+        while True:
+            self.breaker.before_request()
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                # Лимит Telegram, а не сбой API: размыкатель не трогаем
+                self.breaker.release_probe()
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    raise
+                logger.warning(f"{endpoint}: превышен лимит Telegram, пауза {e.retry_after} сек.")
+                if self.limiter is not None:
+                    self.limiter.pause(float(e.retry_after))
+                await asyncio.sleep(float(e.retry_after))
+                continue
+            except PERMANENT_ERRORS as e:
+                # API ответил, значит доступен
+                self.breaker.record_success()
+                if isinstance(e, Forbidden):
+                    await self._mark_blocked(data.get('chat_id'))
+                raise
+            except NetworkError as e:
+                self.breaker.record_failure()
+                attempt += 1
+                if attempt >= self.max_attempts or self.breaker.is_open:
+                    raise
+                delay = self.backoff(attempt)
+                logger.warning(f"{endpoint}: сетевая ошибка ({e}), повтор {attempt} через {delay:.1f} сек.")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self.breaker.release_probe()
+                raise
+            self.breaker.record_success()
+            return result
+
+    async def _mark_blocked(self, chat_id):
+        # Отрицательные ID — группы и каналы, блокируют бота только пользователи
+        if self.on_blocked is None or not isinstance(chat_id, int) or chat_id <= 0:
+            return
+        try:
+            await self.on_blocked(chat_id)
+        except Exception as e:
+            logger.error(f"Ошибка отметки пользователя {chat_id} как заблокировавшего бота: {e}")
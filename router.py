@@ -0,0 +1,124 @@
+import logging
+from collections import Counter
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Версия схемы callback_data: "v1:действие:аргумент:аргумент"
+CALLBACK_VERSION = 'v1'
+
+def callback_data(action: str, *args) -> str:
+    """callback_data кнопки в версионированной схеме"""
+    return ':'.join((CALLBACK_VERSION, action) + tuple(str(arg) for arg in args))
+
+class Route(NamedTuple):
+    handler: Callable[..., Awaitable]
+    arg_types: tuple = ()
+    admin: bool = False
+    # Состояние получает любой текст, в том числе нажатия кнопок меню
+    capture: bool = False
+
+class Router:
+    """Маршрутизация обновлений поиском в словарях:
+    - кнопки — по точному тексту;
+    - состояния — по имени, ref_id состояния (например, id заявки) передается аргументом;
+    - callback — по действию из "v1:действие:аргументы"; кнопки старого формата
+      "действие_аргументы" в уже отправленных сообщениях разбираются так же.
+    Роль проверяется по маршруту, несовпадения считаются в unmatched."""
+
+    def __init__(self, is_admin: Callable[[int], bool]):
+        self.is_admin = is_admin
+        self.buttons: Dict[str, Route] = {}
+        self.states: Dict[str, Route] = {}
+        self.callbacks: Dict[str, Route] = {}
+        self.legacy_callbacks: Dict[str, str] = {}
+        self.unmatched = Counter()
+
+    def button(self, text: str, handler, admin: bool = False):
+        """Маршрут кнопки меню"""
+        self.buttons[text] = Route(handler, admin=admin)
+
+    def state(self, name: str, handler, *arg_types, admin: bool = False, capture: bool = False):
+        """Маршрут состояния пользователя"""
+        self.states[name] = Route(handler, arg_types, admin, capture)
+
+    def callback(self, action: str, handler, *arg_types, admin: bool = True, legacy: str = None):
+        """Маршрут callback-кнопки; legacy — точное значение старого формата без аргументов"""
+        self.callbacks[action] = Route(handler, arg_types, admin)
+        if legacy is not None:
+            self.legacy_callbacks[legacy] = action
+
+    def allowed(self, route: Route, user_id: int) -> bool:
+        """Доступен ли маршрут пользователю"""
+        return not route.admin or self.is_admin(user_id)
+
+    def button_denied(self, user_id: int, text: str) -> bool:
+        """Нажата кнопка меню, недоступная пользователю (например, из устаревшей клавиатуры)"""
+        button = self.buttons.get(text)
+        return button is not None and not self.allowed(button, user_id)
+
+    def callback_allowed(self, match: Optional[Tuple[Route, tuple]], user_id: int) -> bool:
+        """Доступна ли callback-кнопка; неизвестные и поврежденные данные
+        доступны только администраторам, как и все callback-кнопки бота"""
+        if match is None:
+            return self.is_admin(user_id)
+        return self.allowed(match[0], user_id)
+
+    def resolve_message(self, user_id: int, text: str, state: Optional[str],
+                        ref_id: Optional[int] = None) -> Optional[Tuple[Route, tuple]]:
+        """Маршрут текстового сообщения с учетом состояния пользователя"""
+        state_match = self._resolve_state(state, ref_id) if state else None
+        if state_match is not None and not self.allowed(state_match[0], user_id):
+            state_match = None
+
+        if state_match is not None and state_match[0].capture:
+            return state_match
+
+        button = self.buttons.get(text)
+        if button is not None and self.allowed(button, user_id):
+            return button, ()
+
+        if state_match is not None:
+            return state_match
+
+        self.unmatched['message'] += 1
+        return None
+
+    def _resolve_state(self, state: str, ref_id: Optional[int]) -> Optional[Tuple[Route, tuple]]:
+        route = self.states.get(state)
+        if route is None or not route.arg_types:
+            return (route, ()) if route is not None else None
+        if len(route.arg_types) != 1 or ref_id is None:
+            return None
+        return route, (route.arg_types[0](ref_id),)
+
+    def resolve_callback(self, data: str) -> Optional[Tuple[Route, tuple]]:
+        """Маршрут callback-кнопки; None для неизвестных и поврежденных данных"""
+        match = self._parse_callback(data or '')
+        if match is None:
+            self.unmatched['callback'] += 1
+            logger.debug(f"Неизвестный callback: {data!r}")
+        return match
+
+    def _parse_callback(self, data: str) -> Optional[Tuple[Route, tuple]]:
+        if data.startswith(CALLBACK_VERSION + ':'):
+            parts = data.split(':', 2)
+            action, separator = parts[1], ':'
+            rest = parts[2] if len(parts) > 2 else None
+        elif data in self.legacy_callbacks:
+            action, separator, rest = self.legacy_callbacks[data], '_', None
+        else:
+            action, _, rest = data.partition('_')
+            separator = '_'
+
+        route = self.callbacks.get(action)
+        if route is None:
+            return None
+        # Последний аргумент может содержать разделитель (например, дата)
+        raw = rest.split(separator, len(route.arg_types) - 1) if route.arg_types and rest is not None else []
+        if len(raw) != len(route.arg_types):
+            return None
+        try:
+            return route, tuple(arg_type(value) for arg_type, value in zip(route.arg_types, raw))
+        except ValueError:
+            return None
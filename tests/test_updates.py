@@ -0,0 +1,83 @@
+import asyncio
+import os
+from datetime import datetime
+
+os.environ.setdefault('BOT_TOKEN', '123:test')
+os.environ.setdefault('ADMIN_USER_IDS', '1')
+
+from telegram import Chat, Message, Update
+
+from updates import PerChatUpdateProcessor
+
+def make_update(update_id: int, chat_id: int) -> Update:
+    chat = Chat(id=chat_id, type=Chat.PRIVATE)
+    return Update(update_id, message=Message(update_id, datetime.now(), chat, text='text'))
+
+def test_slow_chat_does_not_delay_other_chats():
+    async def scenario():
+        processor = PerChatUpdateProcessor(max_concurrent_updates=2)
+        release = asyncio.Event()
+        done = []
+
+        async def slow_admin_flow():
+            await release.wait()
+            done.append('A1')
+
+        async def handler(name):
+            done.append(name)
+
+        first = asyncio.create_task(processor.process_update(make_update(1, 100), slow_admin_flow()))
+        await asyncio.sleep(0)
+        # Второе обновление чата A ждет в очереди чата и не занимает слот общего лимита
+        queued = asyncio.create_task(processor.process_update(make_update(2, 100), handler('A2')))
+        other = asyncio.create_task(processor.process_update(make_update(3, 200), handler('B1')))
+        await asyncio.wait_for(other, timeout=1)
+        await queued
+
+        assert done == ['B1']
+        assert not first.done()
+
+        release.set()
+        await asyncio.wait_for(first, timeout=1)
+        assert done == ['B1', 'A1', 'A2']
+
+    asyncio.run(scenario())
+
+def test_updates_of_one_chat_keep_order():
+    async def scenario():
+        processor = PerChatUpdateProcessor(max_concurrent_updates=8)
+        done = []
+
+        async def handler(name, delay):
+            await asyncio.sleep(delay)
+            done.append(name)
+
+        await asyncio.gather(*(
+            processor.process_update(make_update(index, 100), handler(index, 0.01 * (5 - index)))
+            for index in range(5)
+        ))
+
+        assert done == [0, 1, 2, 3, 4]
+
+    asyncio.run(scenario())
+
+def test_failed_update_does_not_stop_chat_queue():
+    async def scenario():
+        processor = PerChatUpdateProcessor(max_concurrent_updates=2)
+        done = []
+
+        async def failing():
+            await asyncio.sleep(0.01)
+            raise RuntimeError('boom')
+
+        async def handler(name):
+            done.append(name)
+
+        await asyncio.gather(
+            processor.process_update(make_update(1, 100), failing()),
+            processor.process_update(make_update(2, 100), handler('after')),
+        )
+
+        assert done == ['after']
+
+    asyncio.run(scenario())
@@ -0,0 +1,65 @@
+import logging
+from collections import deque
+from typing import Awaitable, Deque, Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from config import MAX_CONCURRENT_UPDATES
+
+logger = logging.getLogger(__name__)
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных чатов; обновления одного чата
+    обрабатываются строго по очереди, поэтому шаги анкеты не гоняются друг с другом.
+    Обновление чата, который уже обрабатывается, ставится в очередь этого чата и сразу
+    освобождает слот общего лимита: ждущие обновления не занимают слоты других пользователей."""
+
+    def __init__(self, max_concurrent_updates: int = MAX_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        # Очереди чатов, которые сейчас обрабатываются
+        self._chats: Dict[Hashable, Deque[Awaitable]] = {}
+
+    @staticmethod
+    def chat_key(update: object) -> Optional[Hashable]:
+        """Ключ очереди: чат обновления, иначе пользователь"""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        key = self.chat_key(update)
+        if key is None:
+            await coroutine
+            return
+
+        queue = self._chats.get(key)
+        if queue is not None:
+            # Чат уже обрабатывается: обновление выполнит тот же обработчик по порядку
+            queue.append(coroutine)
+            return
+
+        queue = self._chats[key] = deque([coroutine])
+        try:
+            while queue:
+                try:
+                    await queue[0]
+                except Exception as e:
+                    logger.error(f"Ошибка обработки обновления чата {key}: {e}")
+                queue.popleft()
+        finally:
+            del self._chats[key]
+            # При отмене оставшиеся обновления чата уже не будут обработаны
+            for pending in queue:
+                if hasattr(pending, 'close'):
+                    pending.close()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass